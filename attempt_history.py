@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+from transfer_metrics import attempt_speed_MBps
+
+# Filelist keys holding raw attempts, and the key of the aggregate older attempts are rolled into
+SUMMARY_KEYS = {
+    'upload_attempts': 'upload_attempts_summary',
+    'download_attempts': 'download_attempts_summary',
+}
+
+
+def is_successful_upload(attempt):
+    return 'error' not in attempt
+
+def is_successful_download(attempt):
+    # A "head" probe fetches only the first bytes, so there is no content to compare
+    if attempt.get('probe') == 'head':
+        return attempt.get('error') is None
+    return attempt.get('sha256_comparison') == 'Successful'
+
+def measures_speed(attempt):
+    """False for attempts whose speed says nothing about the file: head probes and deduplicated uploads."""
+    return attempt.get('probe') != 'head' and not attempt.get('deduplicated')
+
+IS_SUCCESSFUL = {
+    'upload_attempts': is_successful_upload,
+    'download_attempts': is_successful_download,
+}
+
+
+def empty_summary():
+    return {
+        "attempts": 0,
+        "successes": 0,
+        "first_timestamp": None,
+        "last_timestamp": None,
+        "first_success": None,
+        "last_success": None,
+        "speed_MBps": {"count": 0, "min": None, "max": None, "mean": None},
+    }
+
+
+def add_to_summary(summary, attempt, successful, file_size_bytes):
+    """Fold one raw attempt into a per-file summary."""
+    summary["attempts"] += 1
+    timestamp_start = attempt.get('timestamp_start')
+    timestamp_end = attempt.get('timestamp_end')
+    if timestamp_start and (summary["first_timestamp"] is None or timestamp_start < summary["first_timestamp"]):
+        summary["first_timestamp"] = timestamp_start
+    if timestamp_end and (summary["last_timestamp"] is None or timestamp_end > summary["last_timestamp"]):
+        summary["last_timestamp"] = timestamp_end
+    if not successful:
+        return
+    summary["successes"] += 1
+    if timestamp_end and (summary["first_success"] is None or timestamp_end < summary["first_success"]):
+        summary["first_success"] = timestamp_end
+    if timestamp_end and (summary["last_success"] is None or timestamp_end > summary["last_success"]):
+        summary["last_success"] = timestamp_end
+    speed = attempt_speed_MBps(attempt, file_size_bytes) if measures_speed(attempt) else None
+    if speed is not None:
+        stats = summary["speed_MBps"]
+        stats["count"] += 1
+        stats["min"] = speed if stats["min"] is None else min(stats["min"], speed)
+        stats["max"] = speed if stats["max"] is None else max(stats["max"], speed)
+        stats["mean"] = speed if stats["mean"] is None else stats["mean"] + (speed - stats["mean"]) / stats["count"]
+
+
+def roll_up_attempts(file_info, key, keep):
+    """Keep only the last `keep` raw attempts under `key` and fold the older ones into its summary.
+
+    Returns the number of attempts rolled up. A `keep` of 0 or None keeps everything.
+    """
+    attempts = file_info.get(key)
+    if not keep or not attempts or len(attempts) <= keep:
+        return 0
+    rolled_up = attempts[:-keep]
+    file_info[key] = attempts[-keep:]
+    summary = file_info.setdefault(SUMMARY_KEYS[key], empty_summary())
+    for attempt in rolled_up:
+        add_to_summary(summary, attempt, IS_SUCCESSFUL[key](attempt), file_info.get('size', 0))
+    return len(rolled_up)
+
+
+def roll_up_file(file_info, keep):
+    """Apply the history limit to both the upload and the download attempts of an entry."""
+    return sum(roll_up_attempts(file_info, key, keep) for key in SUMMARY_KEYS)
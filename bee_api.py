@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import os
+import json
+import threading
+import mimetypes
+import http.client
+from urllib.parse import urlsplit, quote
+
+DEFAULT_BEE_API_ENDPOINT = "http://localhost:1633"
+
+# Size of the blocks streamed from disk to the socket
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Size of the buffer used when reading downloads from the socket
+DOWNLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class BeeApiError(Exception):
+    """Raised when Bee answers a request with a non-success status."""
+
+    def __init__(self, status, reason, body):
+        super().__init__(f"Bee API returned {status} {reason}: {body}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class RangeNotSupportedError(BeeApiError):
+    """Raised when Bee answers a Range request with the whole file."""
+
+
+class BeeClient:
+    """Minimal client for the Bee HTTP API.
+
+    Every thread gets its own keep-alive connection which is reused for all
+    requests made from that thread, so the client can be shared by a pool of
+    upload or download workers.
+    """
+
+    def __init__(self, api_endpoint=None, timeout=None):
+        url = urlsplit(api_endpoint or DEFAULT_BEE_API_ENDPOINT)
+        self.scheme = url.scheme or 'http'
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _new_connection(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout, blocksize=UPLOAD_BLOCK_SIZE)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._new_connection()
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        """Close the connection of the calling thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def request(self, method, path, body=None, headers=None, timer=None):
+        """Send a request and return the response, which the caller must read fully.
+
+        A request on a kept-alive connection that the server has meanwhile closed
+        is retried once on a fresh connection. File bodies are rewound first and
+        iterable bodies must yield the same content again when iterated again.
+        An optional transfer_metrics.TransferTimer is told when the request was
+        sent and when the response arrived.
+        """
+        headers = dict(headers or {})
+        for retry in (True, False):
+            connection = self._connection()
+            reused = connection.sock is not None
+            try:
+                connection.request(method, self.base_path + path, body=body, headers=headers)
+                if timer is not None and body is not None:
+                    timer.mark_sent()
+                response = connection.getresponse()
+                if timer is not None:
+                    timer.mark_first_byte()
+                return response
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if not (retry and reused):
+                    raise
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+            except Exception:
+                self.close()
+                raise
+
+    def upload_file(self, file_path, stamp_id, deferred=False, name=None, content_type=None, timer=None):
+        """Upload a single file to /bzz, streaming it from disk, and return the parsed JSON response."""
+        name = name or os.path.basename(file_path)
+        headers = {
+            'Swarm-Postage-Batch-Id': stamp_id,
+            'Swarm-Deferred-Upload': str(deferred).lower(),
+            'Content-Type': content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'Content-Length': str(os.path.getsize(file_path)),
+        }
+        with open(file_path, 'rb') as f:
+            response = self.request('POST', f"/bzz?name={quote(name)}", body=f, headers=headers, timer=timer)
+            response_body = response.read().decode('utf-8')
+        if response.status not in (200, 201):
+            raise BeeApiError(response.status, response.reason, response_body)
+        return json.loads(response_body)
+
+    def upload_collection(self, tar_stream, stamp_id, deferred=False, timer=None):
+        """Upload a tar stream as a collection to /bzz and return the parsed JSON response.
+
+        `tar_stream` must be re-iterable and have a `size`, see upload_files.TarStream.
+        """
+        headers = {
+            'Swarm-Postage-Batch-Id': stamp_id,
+            'Swarm-Deferred-Upload': str(deferred).lower(),
+            'Swarm-Collection': 'true',
+            'Content-Type': 'application/x-tar',
+            'Content-Length': str(tar_stream.size),
+        }
+        response = self.request('POST', '/bzz', body=tar_stream, headers=headers, timer=timer)
+        response_body = response.read().decode('utf-8')
+        if response.status not in (200, 201):
+            raise BeeApiError(response.status, response.reason, response_body)
+        return json.loads(response_body)
+
+    def open_download(self, reference, headers=None, timer=None):
+        """Request /bzz/<reference> and return the response for streaming its body.
+
+        The caller must either read the body to the end or call close() when it
+        gives up early, otherwise the connection cannot be reused.
+        """
+        response = self.request('GET', f"/bzz/{reference}", headers=headers, timer=timer)
+        if response.status not in (200, 206):
+            response_body = response.read().decode('utf-8', errors='replace')
+            raise BeeApiError(response.status, response.reason, response_body)
+        return response
+
+    def fetch_range(self, reference, start, end, timer=None):
+        """Fetch bytes start..end (inclusive) of /bzz/<reference>.
+
+        Returns the bytes and the total size of the file from Content-Range.
+        Raises RangeNotSupportedError without reading the body when Bee answers
+        with the whole file instead.
+        """
+        response = self.open_download(reference, headers={'Range': f"bytes={start}-{end}"}, timer=timer)
+        if response.status != 206:
+            # The unread body makes the connection unusable, so it is dropped
+            self.close()
+            raise RangeNotSupportedError(response.status, response.reason, "Bee did not honour the Range header")
+        body = response.read()
+        content_range = response.getheader('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        return body, int(total) if total.isdigit() else None
+
+
+def read_blocks(response, block_size=DOWNLOAD_BLOCK_SIZE):
+    """Yield the body of a response as memoryviews over one reused buffer."""
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        read = response.readinto(buffer)
+        if not read:
+            break
+        yield view[:read]
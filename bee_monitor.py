@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import time
+import threading
+import functools
+from collections import deque, defaultdict
+import psutil
+
+DEFAULT_SAMPLING_INTERVAL = 1.0
+
+# Longest wait between looking for Bee processes when none is running
+MAX_LOOKUP_INTERVAL = 300.0
+
+
+def find_bee_processes(process_name='bee'):
+    """Return psutil.Process objects for all processes with `process_name` in their name."""
+    return [p for p in psutil.process_iter(['pid', 'name']) if process_name in (p.info['name'] or '')]
+
+
+def _count_connections(proc):
+    # Process.connections() was renamed to net_connections() in psutil 6
+    net_connections = getattr(proc, 'net_connections', None) or proc.connections
+    return len(net_connections(kind='inet'))
+
+
+def sample_process(proc):
+    """Take one sample of CPU, memory, disk IO and open connections of a process."""
+    with proc.oneshot():
+        sample = {
+            "pid": proc.pid,
+            "cpu_percent": proc.cpu_percent(),
+            "rss_bytes": proc.memory_info().rss,
+        }
+        try:
+            io = proc.io_counters()
+            sample["read_bytes"] = io.read_bytes
+            sample["write_bytes"] = io.write_bytes
+        except (AttributeError, psutil.AccessDenied):
+            pass  # Not available on every platform or for processes of other users
+        try:
+            sample["connections"] = _count_connections(proc)
+        except psutil.AccessDenied:
+            pass
+    return sample
+
+
+class BeeSampler:
+    """Samples the Bee processes on a background thread at a fixed interval.
+
+    The Bee PIDs are looked up once when the sampler starts, and again only when
+    none of them is alive any more. Looking them up scans every process, so
+    while no Bee runs locally (e.g. with a remote node) the wait between
+    lookups doubles each time, up to MAX_LOOKUP_INTERVAL. Samples are kept with
+    their monotonic time so they can be matched to the time window of each
+    transfer, for as long as the oldest transfer in flight needs them.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLING_INTERVAL, process_name='bee'):
+        self.interval = interval
+        self.process_name = process_name
+        self.samples = deque()
+        self._transfers = []  # Start times of the transfers in flight
+        self._processes = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bee-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        lookup_interval = self.interval
+        while not self._stopped.is_set():
+            if self._processes:
+                self._take_samples()
+                self._stopped.wait(self.interval)
+                continue
+            self._processes = find_bee_processes(self.process_name)
+            for proc in self._processes:
+                try:
+                    proc.cpu_percent()  # The first call only sets the reference point
+                except psutil.Error:
+                    pass
+            if self._processes:
+                lookup_interval = self.interval
+                self._stopped.wait(self.interval)
+            else:
+                self._stopped.wait(lookup_interval)
+                lookup_interval = min(lookup_interval * 2, max(self.interval, MAX_LOOKUP_INTERVAL))
+
+    def _take_samples(self):
+        now = time.perf_counter()
+        alive = []
+        for proc in self._processes:
+            try:
+                sample = sample_process(proc)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue  # Bee has exited, it is looked up again once all are gone
+            except psutil.Error:
+                alive.append(proc)
+                continue
+            alive.append(proc)
+            with self._lock:
+                self.samples.append((now, sample))
+        self._processes = alive
+        with self._lock:
+            # Keep the samples since the last one before the oldest transfer in flight started
+            oldest = min(self._transfers, default=now)
+            keep_from = max((sampled_at for sampled_at, _ in self.samples if sampled_at <= oldest), default=oldest)
+            while self.samples and self.samples[0][0] < keep_from:
+                self.samples.popleft()
+
+    def transfer_started(self):
+        """Keep samples from now on until `transfer_ended()` is called with the returned start time."""
+        started = time.perf_counter()
+        with self._lock:
+            self._transfers.append(started)
+        return started
+
+    def transfer_ended(self, started):
+        """Return the samples taken since `started`, see samples_between()."""
+        ended = time.perf_counter()
+        with self._lock:
+            self._transfers.remove(started)
+        return self.samples_between(started, ended)
+
+    def samples_between(self, started, ended):
+        """Return the samples taken between two time.perf_counter() values.
+
+        The last sample taken before `started` is included as well, so even a
+        transfer shorter than the interval gets the node state it started in.
+        Each sample gets "t", its offset in seconds from `started`.
+        """
+        with self._lock:
+            samples = list(self.samples)
+        window_start = max((sampled_at for sampled_at, _ in samples if sampled_at < started), default=started)
+        return [dict(sample, t=round(sampled_at - started, 3))
+                for sampled_at, sample in samples if window_start <= sampled_at <= ended]
+
+
+def summarize_samples(samples):
+    """Reduce the samples of one transfer to a small summary for its attempt.
+
+    CPU, memory and connections of all Bee processes sampled at the same time
+    are added up, then the peak (and mean CPU) over the transfer is kept. Disk
+    IO is the bytes read and written by each process during the transfer.
+    """
+    if not samples:
+        return {"samples": 0}
+    by_time = defaultdict(list)
+    by_pid = defaultdict(list)
+    for sample in samples:
+        by_time[sample['t']].append(sample)
+        by_pid[sample['pid']].append(sample)
+    cpu = [sum(sample['cpu_percent'] for sample in group) for group in by_time.values()]
+    summary = {
+        "samples": len(by_time),
+        "cpu_percent_max": round(max(cpu), 1),
+        "cpu_percent_mean": round(sum(cpu) / len(cpu), 1),
+        "rss_bytes_max": max(sum(sample['rss_bytes'] for sample in group) for group in by_time.values()),
+    }
+    if all('connections' in sample for sample in samples):
+        summary["connections_max"] = max(sum(sample['connections'] for sample in group) for group in by_time.values())
+    for key in ('read_bytes', 'write_bytes'):
+        if all(key in sample for sample in samples):
+            summary[key] = sum(group[-1][key] - group[0][key] for group in by_pid.values())
+    return summary
+
+
+def with_bee_samples(transfer_function, sampler):
+    """Wrap an upload or download function so every attempt gets a "bee_summary" of its time window.
+
+    Functions returning a list of attempts (batch uploads) get the summary added to each of them.
+    """
+    @functools.wraps(transfer_function)
+    def wrapper(file_info, settings):
+        started = sampler.transfer_started()
+        try:
+            result = transfer_function(file_info, settings)
+        finally:
+            bee_summary = summarize_samples(sampler.transfer_ended(started))
+        for attempt in (result if isinstance(result, list) else [result]):
+            attempt['bee_summary'] = dict(bee_summary)
+        return result
+    return wrapper
+
+
+def start_sampler(settings):
+    """Start a BeeSampler as configured by bee_sampling_interval, or return None when it is disabled (the default)."""
+    interval = settings.get('bee_sampling_interval', 0)
+    if not interval:
+        return None
+    return BeeSampler(interval, settings.get('bee_process_name', 'bee')).start()
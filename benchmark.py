@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import os
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import yaml
+from generate_filelist import generate_filelist
+from upload_files import get_upload_nodes, select_files_to_upload, run_uploads
+from download_files import get_download_nodes, run_downloads
+from generate_report import generate_csv_report, ReportStats
+from mock_bee import start_mock_bee, MockBeeState
+
+
+def generate_corpus(corpus_path, files, distribution, mean_size, max_size, seed):
+    """Write `files` files of random content whose sizes follow `distribution`.
+
+    The same seed always produces the same sizes, so runs can be compared.
+    """
+    rng = random.Random(seed)
+    os.makedirs(corpus_path, exist_ok=True)
+    total = 0
+    for i in range(files):
+        if distribution == 'fixed':
+            size = mean_size
+        elif distribution == 'uniform':
+            size = rng.randint(0, 2 * mean_size)
+        elif distribution == 'lognormal':
+            # sigma 1.5 gives many small files and a long tail of large ones
+            size = int(rng.lognormvariate(0, 1.5) * mean_size / 3.08)
+        else:
+            raise ValueError(f"Unknown size distribution: {distribution}")
+        size = max(1, min(size, max_size))
+        with open(os.path.join(corpus_path, f"file_{i:06d}.bin"), 'wb') as f:
+            f.write(rng.randbytes(size))
+        total += size
+    return total
+
+
+def measure(stage, run, files, total_bytes, server=None, concurrency=1, **labels):
+    """Run one stage and return its throughput and the tool's own overhead per file.
+
+    The overhead is the wall time per file minus the time the mock Bee spent
+    serving it, spread over the requests that were in flight together.
+    """
+    busy_before = server.bee.busy_seconds if server else 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - started
+    server_seconds = (server.bee.busy_seconds - busy_before) if server else 0.0
+    overhead = max(0.0, seconds - server_seconds / concurrency) / files if files else None
+    return dict(labels, stage=stage, concurrency=concurrency, files=files, MB=total_bytes / (1024 * 1024),
+                seconds=seconds, files_per_s=files / seconds if seconds else None,
+                MB_per_s=total_bytes / (1024 * 1024) / seconds if seconds else None,
+                overhead_ms_per_file=overhead * 1000 if overhead is not None else None)
+
+
+def run_backend(filelist_path, workdir, backend, concurrency, latency, bandwidth, error_rate, extra_settings,
+                node_count=1):
+    """Upload, download and report the corpus against fresh mock Bee nodes with one backend setting.
+
+    With several nodes, `concurrency` applies to each of them.
+    """
+    bee = MockBeeState(latency, bandwidth, error_rate)
+    servers = [start_mock_bee(bee=bee) for _ in range(node_count)]
+    server = servers[0]
+    settings = {
+        'bee_api_endpoint': f"http://127.0.0.1:{server.server_port}",
+        'stamp_id': '0' * 64,
+        'deferred_upload': False,
+        'upload_backend': backend,
+        'download_backend': backend,
+        'download_location_path': os.path.join(workdir, f"downloads_{backend}_{concurrency}"),
+        'bee_sampling_interval': 0,
+    }
+    if node_count > 1:
+        settings['bee_nodes'] = [{'name': f"node{i + 1}", 'bee_api_endpoint': f"http://127.0.0.1:{node.server_port}"}
+                                 for i, node in enumerate(servers)]
+    settings.update(extra_settings)
+    settings['upload_concurrency'] = concurrency
+    with open(filelist_path, 'r') as f:
+        file_list = json.load(f)
+    total_bytes = sum(file_info['size'] for file_info in file_list)
+    labels = {'backend': backend, 'nodes': node_count}
+    results = []
+
+    try:
+        def record_upload_attempt(file_info, attempt, swarm_hash):
+            file_info['upload_attempts'] = [attempt]
+            if swarm_hash:
+                file_info['swarmHash'] = swarm_hash
+
+        def upload():
+            run_uploads(select_files_to_upload(file_list, 'all', float('inf')), settings, get_upload_nodes(settings),
+                        record_upload_attempt)
+        results.append(measure('upload', upload, len(file_list), total_bytes, server, concurrency * node_count,
+                               **labels))
+        results[-1]['errors'] = sum(1 for file_info in file_list if 'error' in file_info['upload_attempts'][0])
+
+        uploaded = [file_info for file_info in file_list if 'swarmHash' in file_info]
+
+        download_concurrency = settings.get('download_concurrency', 1)
+
+        def record_download_attempt(file_info, attempt):
+            file_info['download_attempts'] = [attempt]
+
+        def download():
+            run_downloads(uploaded, settings, get_download_nodes(settings), record_download_attempt)
+        results.append(measure('download', download, len(uploaded), sum(file_info['size'] for file_info in uploaded),
+                               server, download_concurrency * node_count, **labels))
+        results[-1]['errors'] = sum(1 for file_info in uploaded if file_info['download_attempts'][0].get('error'))
+
+        def report():
+            generate_csv_report(file_list, os.path.join(workdir, 'report.csv'), ReportStats())
+        results.append(measure('report', report, len(file_list), total_bytes, **labels))
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def print_results(results):
+    columns = ['stage', 'backend', 'nodes', 'concurrency', 'files', 'errors', 'MB', 'seconds', 'files_per_s',
+               'MB_per_s', 'overhead_ms_per_file']
+    widths = [max(len(column), 10) for column in columns]
+    print('  '.join(f"{column:>{width}}" for column, width in zip(columns, widths)))
+    for result in results:
+        values = []
+        for column, width in zip(columns, widths):
+            value = result.get(column, '')
+            values.append(f"{value:>{width}.3f}" if isinstance(value, float) else f"{str(value):>{width}}")
+        print('  '.join(values))
+
+
+def parse_setting(text):
+    key, _, value = text.partition('=')
+    return key, yaml.safe_load(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark hashing, upload, download and report against a mock Bee.')
+    parser.add_argument('--files', type=int, default=200, help='Number of files in the synthetic corpus')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='Mean file size in bytes')
+    parser.add_argument('--max-size', type=int, default=64 * 1024 * 1024, help='Maximum file size in bytes')
+    parser.add_argument('--distribution', choices=['fixed', 'uniform', 'lognormal'], default='lognormal',
+                        help='File size distribution')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the corpus')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mock Bee latency per request in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Mock Bee bandwidth per connection in bytes/s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of mock Bee requests failing with 500')
+    parser.add_argument('--backends', nargs='+', default=['http'], help='Backends to compare (http, swarm-cli)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4], help='Upload concurrency settings to compare')
+    parser.add_argument('--nodes', type=int, default=1, help='Number of mock Bee nodes to spread transfers over')
+    parser.add_argument('--jobs', type=int, default=None, help='Hashing processes for generate_filelist')
+    parser.add_argument('--set', dest='settings', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra setting passed to the upload/download code, may be repeated')
+    parser.add_argument('--workdir', default=None, help='Directory for the corpus and results (default: temporary)')
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='swarm_benchmark_')
+    try:
+        corpus_path = os.path.join(workdir, 'corpus')
+        total_bytes = generate_corpus(corpus_path, args.files, args.distribution, args.size, args.max_size, args.seed)
+        print(f"Corpus: {args.files} files, {total_bytes / (1024 * 1024):.2f} MB ({args.distribution}) in {corpus_path}")
+
+        filelist_path = os.path.join(workdir, 'filelist.json')
+        results = [measure('hash', lambda: generate_filelist(corpus_path, True, filelist_path, args.jobs),
+                           args.files, total_bytes, concurrency=args.jobs or os.cpu_count(), backend='-')]
+        extra_settings = dict(parse_setting(text) for text in args.settings)
+        for backend in args.backends:
+            for concurrency in args.concurrency:
+                results.extend(run_backend(filelist_path, workdir, backend, concurrency,
+                                           args.latency, args.bandwidth, args.error_rate, extra_settings, args.nodes))
+
+        print_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=4)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
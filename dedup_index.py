@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import json
+import argparse
+import threading
+from datetime import datetime
+import yaml
+from filelist_state import iter_filelist
+
+
+class DedupIndex:
+    """Persistent index from file content (sha256 and size) to the Swarm reference it was uploaded as.
+
+    The index is a JSON lines file that only ever grows: loading reads every
+    line, adding a reference appends one. Several filelists and runs can share
+    it, and a torn line left by a crash is skipped.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.references = {}
+        self._lock = threading.Lock()
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.references[(record['sha256'], record['size'])] = record
+        self._file = None
+
+    def lookup(self, file_info):
+        """Return the index record for the content of a filelist entry, or None."""
+        return self.references.get((file_info['sha256'], file_info['size']))
+
+    def add(self, file_info, reference, stamp_id=None):
+        """Remember that the content of `file_info` was uploaded as `reference`."""
+        key = (file_info['sha256'], file_info['size'])
+        with self._lock:
+            if key in self.references:
+                return
+            record = {"sha256": file_info['sha256'], "size": file_info['size'], "reference": reference,
+                      "stamp_id": stamp_id, "added": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            self.references[key] = record
+            if self._file is None:
+                self._file = open(self.index_path, 'a')
+                if self._file.tell() > 0 and not self._ends_with_newline():
+                    self._file.write("\n")  # Start after a line torn by a crash
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def _ends_with_newline(self):
+        with open(self.index_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def open_dedup_index(settings):
+    """Open the index at dedup_index_path, or return None when deduplication is disabled."""
+    index_path = settings.get('dedup_index_path')
+    return DedupIndex(index_path) if index_path else None
+
+
+def report_duplicates(file_infos, dedup_index=None):
+    """Pass filelist entries through, then print how many duplicate the index or each other."""
+    seen = set()
+    indexed = indexed_bytes = repeated = repeated_bytes = 0
+    for file_info in file_infos:
+        if file_info.get('removed'):
+            yield file_info
+            continue
+        key = (file_info['sha256'], file_info['size'])
+        if dedup_index is not None and dedup_index.lookup(file_info):
+            indexed += 1
+            indexed_bytes += file_info['size']
+        elif key in seen:
+            repeated += 1
+            repeated_bytes += file_info['size']
+        seen.add(key)
+        yield file_info
+    if dedup_index is not None:
+        print(f"Already uploaded according to {dedup_index.index_path}: {indexed} files, "
+              f"{indexed_bytes / (1024 * 1024):.2f} MB")
+    print(f"Duplicates within the file list: {repeated} files, {repeated_bytes / (1024 * 1024):.2f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the uploaded files of filelists to the deduplication index.')
+    parser.add_argument('filelists', nargs='+', help='Filelist JSON files to import')
+    parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
+    parser.add_argument('-D', '--dedup-index', default=None,
+                        help='Path to the deduplication index (default: dedup_index_path from the settings)')
+    args = parser.parse_args()
+
+    index_path = args.dedup_index
+    if not index_path:
+        with open(args.settings, 'r') as f:
+            index_path = yaml.safe_load(f).get('dedup_index_path')
+    if not index_path:
+        parser.error('no deduplication index given and dedup_index_path is not set')
+
+    dedup_index = DedupIndex(index_path)
+    before = len(dedup_index.references)
+    for filelist_path in args.filelists:
+        for file_info in iter_filelist(filelist_path):
+            if 'swarmHash' in file_info and not file_info.get('removed'):
+                dedup_index.add(file_info, file_info['swarmHash'])
+    dedup_index.close()
+    print(f"Added {len(dedup_index.references) - before} references to {index_path}")
@@ -1,37 +1,34 @@
 #!/usr/bin/env python3
 import os
-import json
 import yaml
 import argparse
 import subprocess
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
-import psutil
-import time
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from bee_api import BeeClient, RangeNotSupportedError, read_blocks, DOWNLOAD_BLOCK_SIZE
+from filelist_state import open_state
+from transfer_metrics import TransferTimer, TIME_FORMAT, parse_time_output
+from bee_monitor import start_sampler, with_bee_samples
+from transfer_controller import run_on_nodes, nodes_from_settings
+from live_metrics import start_live_metrics
 
 def load_settings(settings_path):
     with open(settings_path, 'r') as f:
         return yaml.safe_load(f)
 
-def load_filelist(filelist_path):
-    with open(filelist_path, 'r') as f:
-        return json.load(f)
-        
 def calculate_sha256(file_path):
     hasher = hashlib.sha256()
     with open(file_path, 'rb') as f:
         while chunk := f.read(4096):
             hasher.update(chunk)
     return hasher.hexdigest()
-    
-def save_filelist(filelist, filelist_path):
-    with open(filelist_path, 'w') as f:
-        json.dump(filelist, f, indent=4)
-        
-def calculate_duration_and_speed(timestamp_start, timestamp_end, file_size_bytes):
-    FMT = '%Y-%m-%d %H:%M:%S'
-    tdelta = datetime.strptime(timestamp_end, FMT) - datetime.strptime(timestamp_start, FMT)
-    duration_seconds = tdelta.total_seconds()
+
+def calculate_size_and_speed(file_size_bytes, metrics):
+    duration_seconds = metrics['duration_s']
     file_size_MB = file_size_bytes / (1024 * 1024)
     if duration_seconds > 0:
         avg_speed = file_size_MB / duration_seconds
@@ -39,18 +36,6 @@ def calculate_duration_and_speed(timestamp_start, timestamp_end, file_size_bytes
         avg_speed = 0  # Avoid division by zero
     return file_size_MB, avg_speed
 
-def print_bee_processes_info():
-    # Find all "bee" processes
-    bee_processes = [p for p in psutil.process_iter(['pid', 'name', 'memory_info', 'cpu_percent']) if 'bee' in p.info['name']]
-    for proc in bee_processes:
-        try:
-            print(f"Bee Process PID: {proc.info['pid']} | Memory: {proc.info['memory_info'].rss / 1024 ** 2:.2f} MB | CPU: {proc.info['cpu_percent']}%")
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass  # Process has been terminated or cannot access information
-
-
-
-
 def download_file(file_info, settings):
     timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     file_size_MB = file_info['size'] / (1024 * 1024)
@@ -60,66 +45,317 @@ def download_file(file_info, settings):
 
     print(f"Working on file: {file_info['filename']}  start: {timestamp_start}  file size: {file_size_MB:.2f} MB")
 
-    # Print initial info about "bee" processes
-    print_bee_processes_info()
-
     # Modified command to include the 'time' utility
     cmd = [
-        '/usr/bin/time', '-f', '"%e real,%U user,%S sys,%M KB max memory,%P CPU"', # Formatting for time output
+        '/usr/bin/time', '-f', TIME_FORMAT, # Formatting for time output
         'swarm-cli', 'download', file_info['swarmHash'], settings['download_location_path'],
         '--quiet', '--curl'
     ]
 
-    try:
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        # Print initial info about "bee" processes
-        print_bee_processes_info()
-
-        # Loop to wait for the download process to complete while printing "bee" process info
-        while True:
-            # Check if process has finished
-            if process.poll() is not None:
-                break
+    if settings.get('bee_api_endpoint'):
+        cmd.extend(['--bee-api-url', settings['bee_api_endpoint']])
 
-            # Print CPU and memory info of "bee" processes
-            print_bee_processes_info()
-
-            # Wait for a short period before checking again
-            time.sleep(5)
+    timer = TransferTimer()
 
+    try:
+        # Bee processes are sampled in the background by bee_monitor.BeeSampler
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = process.communicate()
 
         timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = timer.metrics(file_info['size'] if process.returncode == 0 else 0)
 
         download_path = os.path.join(settings['download_location_path'], file_info['filename'])
         calculated_hash = calculate_sha256(download_path)
-        
+
         sha256_comparison = "Failed" if calculated_hash != file_info['sha256'] else "Successful"
 
         # Assuming the last line in stderr is the time utility output
         time_output = stderr.decode('utf-8').strip().split('\n')[-1]
+        process_metrics = parse_time_output(time_output)
 
-        print(f"Time metrics: {time_output}")  # Print the time metrics
+        print(f"Time metrics: {metrics}  Process: {process_metrics}")  # Print the time metrics
 
         return {
             "timestamp_start": timestamp_start,
             "timestamp_end": timestamp_end,
             "sha256_comparison": sha256_comparison,
-            "time_metrics": time_output,  # Save the time metrics
+            "metrics": metrics,
+            "process_metrics": process_metrics,
             "response_body": stdout.decode('utf-8').strip(),
             "error": stderr.decode('utf-8').strip() if process.returncode != 0 else None
         }
-        
+
     except Exception as e:
         timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         return {
             "timestamp_start": timestamp_start,
             "timestamp_end": timestamp_end,
             "sha256_comparison": "Failed",
+            "metrics": timer.metrics(0),
             "error": str(e)
         }
 
+class SizeMismatchError(Exception):
+    """Raised when Bee returns a different number of bytes than the filelist expects."""
+
+
+def download_file_http(file_info, settings, bee_client, range_executor=None):
+    """Stream a file from the Bee API, hashing it while it arrives.
+
+    The body is written to the download location in the same pass, or thrown away
+    when `download_discard` is set, so the file is never read back from disk.
+    """
+    ranged_download_above = settings.get('ranged_download_above')
+    if ranged_download_above and file_info['size'] >= ranged_download_above:
+        return download_file_ranged(file_info, settings, bee_client, range_executor)
+
+    timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    file_size_MB = file_info['size'] / (1024 * 1024)
+    print(f"Working on file: {file_info['filename']}  start: {timestamp_start}  file size: {file_size_MB:.2f} MB")
+    timer = TransferTimer()
+
+    discard = settings.get('download_discard', False)
+    block_size = settings.get('download_block_size', DOWNLOAD_BLOCK_SIZE)
+    hasher = hashlib.sha256()
+    received = 0
+    out = None
+
+    try:
+        response = bee_client.open_download(file_info['swarmHash'], timer=timer)
+        try:
+            content_length = response.getheader('Content-Length')
+            if content_length is not None and int(content_length) != file_info['size']:
+                raise SizeMismatchError(f"Bee reports {content_length} bytes, expected {file_info['size']}")
+
+            if not discard:
+                download_directory = settings['download_location_path']
+                os.makedirs(download_directory, exist_ok=True)
+                out = open(os.path.join(download_directory, file_info['filename']), 'wb')
+
+            for block in read_blocks(response, block_size):
+                received += len(block)
+                if received > file_info['size']:
+                    raise SizeMismatchError(f"Received more than the expected {file_info['size']} bytes")
+                hasher.update(block)
+                if out is not None:
+                    out.write(block)
+        except BaseException:
+            # The rest of the body was not read, so the connection cannot be reused
+            bee_client.close()
+            raise
+        finally:
+            if out is not None:
+                out.close()
+
+        if received != file_info['size']:
+            raise SizeMismatchError(f"Received {received} bytes, expected {file_info['size']}")
+
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        sha256_comparison = "Failed" if hasher.hexdigest() != file_info['sha256'] else "Successful"
+        metrics = timer.metrics(received)
+        print(f"Time metrics: {metrics}")
+
+        return {
+            "timestamp_start": timestamp_start,
+            "timestamp_end": timestamp_end,
+            "sha256_comparison": sha256_comparison,
+            "metrics": metrics,
+            "response_body": "",
+            "error": None
+        }
+
+    except Exception as e:
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "timestamp_start": timestamp_start,
+            "timestamp_end": timestamp_end,
+            "sha256_comparison": "Failed",
+            "metrics": timer.metrics(received),
+            "error": str(e)
+        }
+
+
+def get_range_executor(settings):
+    """Return the thread pool that fetches the parts of ranged downloads, or None when they are off.
+
+    One pool serves all files of a run, so its threads keep their keep-alive
+    connections from one file to the next.
+    """
+    if not settings.get('ranged_download_above'):
+        return None
+    if settings.get('adaptive_concurrency', False):
+        concurrency = settings.get('max_concurrency', 16)
+    else:
+        concurrency = settings.get('download_concurrency', 1)
+    return ThreadPoolExecutor(max_workers=settings.get('ranged_download_parallelism', 4) * max(1, int(concurrency)),
+                              thread_name_prefix='ranged-download')
+
+
+def download_file_ranged(file_info, settings, bee_client, range_executor=None):
+    """Download a large file as parallel HTTP Range requests and verify its SHA-256.
+
+    Up to ranged_download_parallelism parts of ranged_download_part_size bytes are
+    fetched at once on `range_executor` (or a pool of its own) and written at
+    their offset into a preallocated file. Parts are hashed in file order as soon
+    as all earlier parts are in, so only the parts in flight are held in memory
+    and the file is never read back. When Bee ignores the Range header the file
+    is downloaded as a single stream instead.
+    """
+    timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    size = file_info['size']
+    part_size = settings.get('ranged_download_part_size', 16 * 1024 * 1024)
+    parallelism = settings.get('ranged_download_parallelism', 4)
+    print(f"Working on file: {file_info['filename']}  start: {timestamp_start}  file size: {size / (1024 * 1024):.2f} MB"
+          f"  in {-(-size // part_size)} parts")
+    timer = TransferTimer()
+    hasher = hashlib.sha256()
+    received = 0
+    out = None
+
+    def fetch_part(start):
+        body, total = bee_client.fetch_range(file_info['swarmHash'], start, min(start + part_size, size) - 1, timer=timer)
+        if total is not None and total != size:
+            raise SizeMismatchError(f"Bee reports {total} bytes, expected {size}")
+        if len(body) != min(part_size, size - start):
+            raise SizeMismatchError(f"Received {len(body)} bytes for the part at {start}")
+        return body
+
+    try:
+        if not settings.get('download_discard', False):
+            download_directory = settings['download_location_path']
+            os.makedirs(download_directory, exist_ok=True)
+            out = open(os.path.join(download_directory, file_info['filename']), 'wb')
+            out.truncate(size)
+
+        executor = range_executor or ThreadPoolExecutor(max_workers=parallelism)
+        in_flight = deque()
+
+        def consume_oldest_part():
+            # Parts are hashed in file order, so always wait for the oldest one
+            nonlocal received
+            start, future = in_flight.popleft()
+            body = future.result()
+            hasher.update(body)
+            received += len(body)
+            if out is not None:
+                os.pwrite(out.fileno(), body, start)
+
+        try:
+            for start in range(0, size, part_size):
+                in_flight.append((start, executor.submit(fetch_part, start)))
+                if len(in_flight) >= parallelism:
+                    consume_oldest_part()
+            while in_flight:
+                consume_oldest_part()
+        finally:
+            for _, future in in_flight:
+                future.cancel()
+            if range_executor is None:
+                executor.shutdown()
+
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        sha256_comparison = "Failed" if hasher.hexdigest() != file_info['sha256'] else "Successful"
+        metrics = timer.metrics(received)
+        print(f"Time metrics: {metrics}")
+
+        return {
+            "timestamp_start": timestamp_start,
+            "timestamp_end": timestamp_end,
+            "sha256_comparison": sha256_comparison,
+            "metrics": metrics,
+            "ranges": {"part_size": part_size, "parallelism": parallelism},
+            "response_body": "",
+            "error": None
+        }
+
+    except RangeNotSupportedError:
+        print(f"Bee ignored the Range header, downloading {file_info['filename']} as a single stream")
+        if out is not None:
+            out.close()
+            out = None
+        return download_file_http(file_info, dict(settings, ranged_download_above=None), bee_client)
+
+    except Exception as e:
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "timestamp_start": timestamp_start,
+            "timestamp_end": timestamp_end,
+            "sha256_comparison": "Failed",
+            "metrics": timer.metrics(received),
+            "error": str(e)
+        }
+    finally:
+        if out is not None:
+            out.close()
+
+
+def get_download_function(settings):
+    """Return the download function for the configured download_backend ("swarm-cli" or "http")."""
+    download_backend = settings.get('download_backend', 'swarm-cli')
+    if download_backend == 'http':
+        bee_client = BeeClient(settings.get('bee_api_endpoint'))
+        return functools.partial(download_file_http, bee_client=bee_client, range_executor=get_range_executor(settings))
+    if download_backend == 'swarm-cli':
+        return download_file
+    raise ValueError(f"Unknown download_backend: {download_backend}")
+
+
+def select_files_to_download(file_list):
+    """Yield the entries of the filelist that have a Swarm hash to download."""
+    for file_info in file_list:
+        if 'swarmHash' not in file_info:
+            print(f"Skipping {file_info['filename']} as it does not have a Swarm hash.")
+            continue
+        yield file_info
+
+
+def get_download_nodes(settings, bee_sampler=None):
+    """Return the Bee nodes to download from, each with the download function for its endpoint."""
+    nodes = nodes_from_settings(settings, 'download_concurrency')
+    for node in nodes:
+        node.download_function = get_download_function(node.settings)
+        if bee_sampler:
+            node.download_function = with_bee_samples(node.download_function, bee_sampler)
+    return nodes
+
+
+def run_downloads(files_to_download, settings, nodes, on_attempt, streaming=False, stop=None):
+    """Download files through a pool of worker threads spread over one or more Bee nodes.
+
+    With several nodes, files are dispatched largest first to the least loaded
+    node. Each attempt, including retries of failed downloads, gets the
+    "bee_node" that handled it and is handed to `on_attempt(file_info,
+    download_attempt)` on the calling thread. Downloads to the same path run
+    one after another, so one cannot overwrite a file another is still writing
+    or hashing. With `streaming` set, `files_to_download` may block waiting for
+    files (see run_on_nodes) and they are downloaded in the order they arrive.
+    Setting the `stop` Event ends the run once the running downloads are
+    recorded. Returns the entries whose download still failed after all retries.
+    """
+    # Entries with the same filename from different folders are written to the same path
+    path_locks = {}
+
+    def run_job(node, file_info):
+        if node.settings.get('download_discard') and node.settings.get('download_backend') == 'http':
+            return node.download_function(file_info, node.settings)
+        download_path = os.path.abspath(os.path.join(node.settings['download_location_path'], file_info['filename']))
+        with path_locks.setdefault(download_path, threading.Lock()):
+            return node.download_function(file_info, node.settings)
+
+    def on_done(node, file_info, download_attempt):
+        download_attempt['bee_node'] = node.name
+        on_attempt(file_info, download_attempt)
+        succeeded = not download_attempt.get('error')
+        return succeeded, file_info['size'] if succeeded else 0
+
+    def job_size(file_info):
+        return file_info['size']
+
+    return run_on_nodes(files_to_download, nodes, run_job, on_done, job_size,
+                        largest_first=len(nodes) > 1 and not streaming, streaming=streaming, stop=stop)
+
+
 # Main script
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Download files.')
@@ -127,50 +363,73 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     settings = load_settings(args.settings)
-    file_list = load_filelist(settings['file_info_path'])
+    state = open_state(settings)
+    file_list = state.file_list
 
     # ... (Check and create download directory)
 
+    # Bee nodes to download from, each with its own parallel downloads and retries
+    bee_sampler = start_sampler(settings)
+    nodes = get_download_nodes(settings, bee_sampler)
+
+    files_to_download = list(select_files_to_download(file_list))
+
+    # Progress published while the download runs (metrics_port / metrics_file)
+    live_metrics = start_live_metrics(settings)
+    download_metrics = None
+    if live_metrics:
+        download_metrics = live_metrics.add_stage('download', nodes, len(files_to_download),
+                                                  sum(file_info['size'] for file_info in files_to_download))
+
     successful_count = 0
     unsuccessful_count = 0
     sha256_failed_count = 0
 
-try:
-        for file_info in file_list:
-            if 'swarmHash' not in file_info:
-                print(f"Skipping {file_info['filename']} as it does not have a Swarm hash.")
-                continue
+    def record_download_attempt(file_info, download_attempt):
+        global successful_count, sha256_failed_count
+        timestamp_end = download_attempt.get('timestamp_end', '')
 
-            download_attempt = download_file(file_info, settings)
-            timestamp_start = download_attempt.get('timestamp_start', '')
-            timestamp_end = download_attempt.get('timestamp_end', '')
-        
-            # Record this download attempt in the file_info dictionary
-            file_info.setdefault('download_attempts', []).append(download_attempt)  # Add this line
+        # Record this download attempt in the file_info dictionary
+        state.update(file_info, append_fields={'download_attempts': download_attempt})
+        if download_metrics:
+            download_metrics.record(not download_attempt.get('error'), file_info['size'])
 
-            # Calculate file size in MB and average speed in MB/s
-            file_size_MB, avg_speed = calculate_duration_and_speed(timestamp_start, timestamp_end, file_info['size'])
+        # Calculate file size in MB and average speed in MB/s
+        file_size_MB, avg_speed = calculate_size_and_speed(file_info['size'], download_attempt['metrics'])
 
-            if download_attempt.get('error'):
-                print(f"Download failed for: {file_info['filename']}  Error: {download_attempt['error']}")
-                unsuccessful_count += 1
-            else:
-                print(f"Successfully downloaded: {file_info['filename']}  end: {timestamp_end}  average speed: {avg_speed:.2f} MB/s")
-                successful_count += 1
+        if download_attempt.get('error'):
+            print(f"Download failed for: {file_info['filename']}  Error: {download_attempt['error']}")
+        else:
+            print(f"Successfully downloaded: {file_info['filename']}  end: {timestamp_end}  average speed: {avg_speed:.2f} MB/s")
+            successful_count += 1
+            if download_attempt.get('sha256_comparison') == 'Failed':
+                sha256_failed_count += 1
 
-            save_filelist(file_list, settings['file_info_path'])
+    try:
+        failed_downloads = run_downloads(files_to_download, settings, nodes, record_download_attempt)
+        unsuccessful_count = len(failed_downloads)
+
+        state.close()
+        if live_metrics:
+            live_metrics.stop()
+        if bee_sampler:
+            bee_sampler.stop()
 
         print(f"\nDownload Summary:")
         print(f"Successfully downloaded: {successful_count} files")
         print(f"Failed to download: {unsuccessful_count} files")
+        print(f"Retried downloads: {sum(node.controller.retries for node in nodes)}")
         print(f"SHA-256 comparison failed: {sha256_failed_count} files")
 
-except KeyboardInterrupt:
-    print("\nCTRL-C detected. Attempting to save JSON file before exiting.")
-    save_filelist(file_list, settings['file_info_path'])
-    print(f"Download Summary:")
-    print(f"Successfully downloaded: {successful_count} files")
-    print(f"Failed to download: {unsuccessful_count} files")
-    print(f"SHA-256 comparison failed: {sha256_failed_count} files")
-    print("JSON file saved. Exiting now.")
-
+    except KeyboardInterrupt:
+        print("\nCTRL-C detected. Attempting to save JSON file before exiting.")
+        state.close()
+        if live_metrics:
+            live_metrics.stop()
+        if bee_sampler:
+            bee_sampler.stop()
+        print(f"Download Summary:")
+        print(f"Successfully downloaded: {successful_count} files")
+        print(f"Retried downloads: {sum(node.controller.retries for node in nodes)}")
+        print(f"SHA-256 comparison failed: {sha256_failed_count} files")
+        print("JSON file saved. Exiting now.")
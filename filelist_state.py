@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import shutil
+import argparse
+import tempfile
+import yaml
+from attempt_history import SUMMARY_KEYS, roll_up_attempts, roll_up_file
+
+# Number of journal records after which the journal is folded back into the JSON file
+DEFAULT_COMPACT_EVERY = 1000
+
+
+# Whitespace and commas between the entries of the top-level JSON list
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def journal_path_for(filelist_path):
+    return f"{filelist_path}.journal"
+
+
+def _base_marker(filelist_path):
+    """Identify the exact version of the JSON file a journal applies to."""
+    st = os.stat(filelist_path)
+    return {"base_size": st.st_size, "base_mtime_ns": st.st_mtime_ns, "base_inode": st.st_ino}
+
+
+def write_filelist_json(file_list, filelist_path, fsync=False):
+    """Atomically replace the JSON filelist."""
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(filelist_path)), delete=False) as tempf:
+        json.dump(file_list, tempf, indent=4)
+        if fsync:
+            tempf.flush()
+            os.fsync(tempf.fileno())
+    shutil.move(tempf.name, filelist_path)
+
+
+def apply_update(file_info, set_fields=None, append_fields=None):
+    """Apply an update to a filelist entry: overwrite `set_fields`, append to the lists in `append_fields`."""
+    for key, value in (set_fields or {}).items():
+        file_info[key] = value
+    for key, value in (append_fields or {}).items():
+        file_info.setdefault(key, []).append(value)
+
+
+def _find_entry(file_list, record):
+    index = record.get("i")
+    if index is not None and index < len(file_list) and file_list[index].get("full_path") == record["full_path"]:
+        return file_list[index]
+    for file_info in file_list:
+        if file_info.get("full_path") == record["full_path"]:
+            return file_info
+    return None
+
+
+def replay_journal(file_list, filelist_path):
+    """Apply the journal next to `filelist_path` to `file_list`. Returns the number of records applied.
+
+    A journal written for an older version of the JSON file (one that was already
+    compacted) is ignored, and so is a torn last line left by a crash.
+    """
+    journal_path = journal_path_for(filelist_path)
+    if not os.path.exists(journal_path):
+        return 0
+    applied = 0
+    with open(journal_path, 'r') as f:
+        header = f.readline()
+        try:
+            if json.loads(header) != _base_marker(filelist_path):
+                return 0
+        except ValueError:
+            return 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            file_info = _find_entry(file_list, record)
+            if file_info is not None:
+                apply_update(file_info, record.get("set"), record.get("append"))
+                applied += 1
+    return applied
+
+
+def _read_journal_records(filelist_path):
+    """Return the journal records still pending for `filelist_path`, grouped by full_path."""
+    records = {}
+    journal_path = journal_path_for(filelist_path)
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, 'r') as f:
+        try:
+            if json.loads(f.readline()) != _base_marker(filelist_path):
+                return records
+        except ValueError:
+            return records
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            records.setdefault(record["full_path"], []).append(record)
+    return records
+
+
+def iter_filelist(filelist_path, read_size=1024 * 1024):
+    """Yield the entries of a filelist one by one without loading the whole file.
+
+    Pending journal updates are applied to each entry as it is yielded. Memory use
+    is bounded by the largest single entry plus the journal.
+    """
+    journal_records = _read_journal_records(filelist_path)
+    decoder = json.JSONDecoder()
+    with open(filelist_path, 'r') as f:
+        buffer = f.read(read_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{filelist_path} does not contain a JSON list")
+        pos = 1
+        eof = False
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if buffer.startswith(']', pos):
+                return
+            try:
+                file_info, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+                chunk = f.read(read_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            for record in journal_records.get(file_info.get("full_path"), []):
+                apply_update(file_info, record.get("set"), record.get("append"))
+            yield file_info
+
+
+def load_filelist(filelist_path):
+    """Load a filelist, including updates that are still only in its journal."""
+    with open(filelist_path, 'r') as f:
+        file_list = json.load(f)
+    replay_journal(file_list, filelist_path)
+    return file_list
+
+
+def limit_history(file_info, append_fields, history_limit):
+    """Roll the attempts just appended to beyond `history_limit` per list into their summary."""
+    if history_limit:
+        for key in append_fields or {}:
+            if key in SUMMARY_KEYS:
+                roll_up_attempts(file_info, key, history_limit)
+
+
+class JsonState:
+    """Keeps the filelist in memory and rewrites the whole JSON file after every update."""
+
+    def __init__(self, filelist_path, history_limit=None):
+        self.filelist_path = filelist_path
+        self.history_limit = history_limit
+        self.file_list = load_filelist(filelist_path)
+
+    def update(self, file_info, set_fields=None, append_fields=None):
+        apply_update(file_info, set_fields, append_fields)
+        limit_history(file_info, append_fields, self.history_limit)
+        write_filelist_json(self.file_list, self.filelist_path)
+
+    def save(self):
+        write_filelist_json(self.file_list, self.filelist_path)
+
+    def close(self):
+        self.save()
+
+
+class JournalState:
+    """Keeps the filelist in memory and appends every update as one line to a journal.
+
+    Each update costs one short append instead of rewriting the filelist. Every
+    `compact_every` records, and on close, the journal is folded back into the
+    JSON file, which therefore always stays readable by the other scripts.
+    Attempts beyond `history_limit` are rolled up in memory, so they leave the
+    JSON file at the next compaction.
+    """
+
+    def __init__(self, filelist_path, compact_every=DEFAULT_COMPACT_EVERY, fsync=False, history_limit=None):
+        self.filelist_path = filelist_path
+        self.history_limit = history_limit
+        self.journal_path = journal_path_for(filelist_path)
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.file_list = load_filelist(filelist_path)
+        self._index = {id(file_info): i for i, file_info in enumerate(self.file_list)}
+        self._journal = None
+        self._records = 0
+        # Fold in whatever a previous, interrupted run left in the journal
+        self.save()
+
+    def _open_journal(self):
+        self._journal = open(self.journal_path, 'w')
+        self._journal.write(json.dumps(_base_marker(self.filelist_path)) + "\n")
+        self._journal.flush()
+        self._records = 0
+
+    def update(self, file_info, set_fields=None, append_fields=None):
+        apply_update(file_info, set_fields, append_fields)
+        limit_history(file_info, append_fields, self.history_limit)
+        record = {"i": self._index.get(id(file_info)), "full_path": file_info["full_path"]}
+        if set_fields:
+            record["set"] = set_fields
+        if append_fields:
+            record["append"] = append_fields
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._records += 1
+        if self._records >= self.compact_every:
+            self.save()
+
+    def save(self):
+        """Compact: write the full JSON file and start an empty journal for it."""
+        if self._journal is not None:
+            self._journal.close()
+        write_filelist_json(self.file_list, self.filelist_path, fsync=True)
+        self._open_journal()
+
+    def close(self):
+        self.save()
+        self._journal.close()
+        os.remove(self.journal_path)
+
+
+def open_state(settings, filelist_path=None):
+    """Open the filelist with the state_backend configured in settings ("json" or "journal")."""
+    filelist_path = filelist_path or settings['file_info_path']
+    state_backend = settings.get('state_backend', 'json')
+    history_limit = settings.get('attempt_history_limit')
+    if state_backend == 'journal':
+        return JournalState(filelist_path,
+                            compact_every=settings.get('state_compact_every', DEFAULT_COMPACT_EVERY),
+                            fsync=settings.get('state_fsync', False), history_limit=history_limit)
+    if state_backend == 'json':
+        return JsonState(filelist_path, history_limit)
+    raise ValueError(f"Unknown state_backend: {state_backend}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold a leftover journal back into the JSON filelist.')
+    parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
+    parser.add_argument('-F', '--filelist', help='Path to filelist JSON file', default=None)
+    parser.add_argument('-H', '--history-limit', type=int, default=None,
+                        help='Also roll all but the last N attempts of every file into its summary')
+    args = parser.parse_args()
+
+    if args.filelist:
+        filelist_path = args.filelist
+    else:
+        with open(args.settings, 'r') as f:
+            filelist_path = yaml.safe_load(f)['file_info_path']
+
+    file_list = load_filelist(filelist_path)
+    if args.history_limit:
+        rolled_up = sum(roll_up_file(file_info, args.history_limit) for file_info in file_list)
+        print(f"Rolled up {rolled_up} attempts")
+    write_filelist_json(file_list, filelist_path)
+    if os.path.exists(journal_path_for(filelist_path)):
+        os.remove(journal_path_for(filelist_path))
+    print(f"File list compacted: {filelist_path}")
@@ -3,44 +3,195 @@ import os
 import json
 import hashlib
 import argparse
+import textwrap
+import tempfile
+from multiprocessing import Pool
+from dedup_index import DedupIndex, report_duplicates
+from filelist_state import load_filelist, journal_path_for
+
+# Size of the blocks read from disk while hashing
+HASH_BLOCK_SIZE = 1024 * 1024
 
 def sha256(file_path):
     """Generate SHA-256 hash of a file."""
     print(f"Processing {file_path}...")
     sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
+    buffer = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while read := f.readinto(buffer):
+            sha256_hash.update(view[:read])
     return sha256_hash.hexdigest()
 
-def generate_filelist(folder_path, recursive, output_filename):
-    """Generate a JSON file containing file information."""
-    file_list = []
-    
+def walk_files(folder_path, recursive):
+    """Yield (full_path, filename) for every file in the folder."""
     for root, _, files in os.walk(folder_path):
         if not recursive and root != folder_path:
             continue
         for file in files:
-            full_path = os.path.join(root, file)
-            file_info = {
-                "full_path": full_path,
-                "filename": file,
-                "sha256": sha256(full_path),
-                "size": os.path.getsize(full_path)
-            }
-            file_list.append(file_info)
-    
-    with open(output_filename, "w") as f:
-        json.dump(file_list, f, indent=4)
-        print(f"File list generated: {output_filename}")
+            yield os.path.join(root, file), file
+
+def describe_file(path_and_name):
+    """Build the filelist entry for one file. Runs in the worker processes."""
+    full_path, file = path_and_name
+    return {
+        "full_path": full_path,
+        "filename": file,
+        "sha256": sha256(full_path),
+        "size": os.path.getsize(full_path)
+    }
+
+def write_filelist(file_infos, output_filename):
+    """Write entries to the JSON file as they arrive, in the same layout as json.dump(..., indent=4).
+
+    They go to a temporary file that only replaces `output_filename` once
+    complete, so an interrupted run leaves an existing filelist intact.
+    """
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(output_filename)), delete=False) as f:
+        try:
+            f.write("[")
+            separator = "\n"
+            for file_info in file_infos:
+                f.write(separator)
+                f.write(textwrap.indent(json.dumps(file_info, indent=4), "    "))
+                separator = ",\n"
+            f.write("\n]" if separator == ",\n" else "]")
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, output_filename)
+
+def open_index(dedup_index_path):
+    return DedupIndex(dedup_index_path) if dedup_index_path else None
+
+def generate_filelist(folder_path, recursive, output_filename, jobs=None, dedup_index_path=None):
+    """Generate a JSON file containing file information, hashing files in `jobs` processes.
+
+    Duplicate content, within the folder or already in the dedup index, is reported.
+    """
+    files = walk_files(folder_path, recursive)
+    jobs = jobs or os.cpu_count() or 1
+    dedup_index = open_index(dedup_index_path)
+
+    if jobs == 1:
+        write_filelist(report_duplicates(map(describe_file, files), dedup_index), output_filename)
+    else:
+        with Pool(jobs) as pool:
+            # imap keeps the os.walk order while letting the workers run ahead
+            write_filelist(report_duplicates(pool.imap(describe_file, files, chunksize=8), dedup_index), output_filename)
+    if dedup_index:
+        dedup_index.close()
+    print(f"File list generated: {output_filename}")
+
+def load_hash_cache(cache_path):
+    """Load the hash cache, mapping full_path to size, mtime_ns, inode and sha256."""
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, "r") as f:
+        return json.load(f)
+
+def save_hash_cache(hash_cache, cache_path):
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(cache_path)), delete=False) as tempf:
+        json.dump(hash_cache, tempf)
+    os.replace(tempf.name, cache_path)
+
+def hash_files(files, jobs):
+    """Describe (full_path, filename) pairs, hashing them in `jobs` processes."""
+    if jobs == 1 or len(files) < 2:
+        return list(map(describe_file, files))
+    with Pool(jobs) as pool:
+        return pool.map(describe_file, files, chunksize=8)
+
+def update_filelist(folder_path, recursive, output_filename, jobs=None, cache_path=None, dedup_index_path=None):
+    """Re-scan a folder and merge the result into an existing filelist.
+
+    Only files whose path, size, mtime or inode differ from the hash cache are
+    hashed again. Existing entries keep their upload and download history; an
+    entry whose content changed loses its swarmHash so it is uploaded again, and
+    entries for files no longer on disk are marked "removed".
+    """
+    cache_path = cache_path or f"{os.path.splitext(output_filename)[0]}.hashcache.json"
+    jobs = jobs or os.cpu_count() or 1
+    hash_cache = load_hash_cache(cache_path)
+
+    file_list = []
+    if os.path.exists(output_filename):
+        # Includes updates still only in the journal of an interrupted upload/download
+        file_list = load_filelist(output_filename)
+    entries_by_path = {file_info["full_path"]: file_info for file_info in file_list}
+
+    new_cache = {}
+    stat_keys = {}
+    current_files = []
+    to_hash = []
+    for full_path, file in walk_files(folder_path, recursive):
+        st = os.stat(full_path)
+        stat_key = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+        cached = hash_cache.get(full_path)
+        if cached and all(cached.get(k) == v for k, v in stat_key.items()):
+            new_cache[full_path] = cached
+        else:
+            stat_keys[full_path] = stat_key
+            to_hash.append((full_path, file))
+        current_files.append((full_path, file))
+
+    for file_info in hash_files(to_hash, jobs):
+        new_cache[file_info["full_path"]] = dict(stat_keys[file_info["full_path"]], sha256=file_info["sha256"])
+
+    added = changed = removed = 0
+    for full_path, file in current_files:
+        cached = new_cache[full_path]
+        file_info = entries_by_path.get(full_path)
+        if file_info is None:
+            file_list.append({"full_path": full_path, "filename": file, "sha256": cached["sha256"], "size": cached["size"]})
+            added += 1
+            continue
+        file_info.pop("removed", None)
+        if file_info["sha256"] != cached["sha256"] or file_info["size"] != cached["size"]:
+            file_info["sha256"] = cached["sha256"]
+            file_info["size"] = cached["size"]
+            file_info.pop("swarmHash", None)
+            changed += 1
+
+    # Only entries that this scan could have seen are marked as removed
+    folder_prefix = os.path.join(folder_path, "")
+    for file_info in file_list:
+        full_path = file_info["full_path"]
+        in_scope = full_path.startswith(folder_prefix) and (recursive or os.path.dirname(full_path) == os.path.dirname(folder_prefix))
+        if in_scope and full_path not in new_cache and not file_info.get("removed"):
+            file_info["removed"] = True
+            removed += 1
+
+    # Keep cache entries of other folders sharing this cache
+    for full_path, cached in hash_cache.items():
+        if not full_path.startswith(folder_prefix):
+            new_cache.setdefault(full_path, cached)
+
+    dedup_index = open_index(dedup_index_path)
+    write_filelist(report_duplicates(file_list, dedup_index), output_filename)
+    # The journal was folded in above and no longer matches the rewritten file
+    if os.path.exists(journal_path_for(output_filename)):
+        os.remove(journal_path_for(output_filename))
+    if dedup_index:
+        dedup_index.close()
+    save_hash_cache(new_cache, cache_path)
+    print(f"Hashed {len(to_hash)} of {len(current_files)} files: {added} new, {changed} changed, {removed} removed.")
+    print(f"File list updated: {output_filename}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a file list with metadata.")
     parser.add_argument("path", type=str, help="Path to the folder.")
     parser.add_argument("-R", "--recursive", action="store_true", help="Look into subfolders.")
     parser.add_argument("-F", "--filename", type=str, default="filelist.json", help="Output filename for JSON.")
-    
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of hashing processes (default: number of CPUs).")
+    parser.add_argument("-I", "--incremental", action="store_true", help="Only hash new or changed files and merge into an existing file list.")
+    parser.add_argument("-D", "--dedup-index", type=str, default=None, help="Deduplication index to report already uploaded content from.")
+    parser.add_argument("-C", "--cache", type=str, default=None, help="Hash cache file for --incremental (default: <filename>.hashcache.json).")
+
     args = parser.parse_args()
-    
-    generate_filelist(args.path, args.recursive, args.filename)
 
+    if args.incremental:
+        update_filelist(args.path, args.recursive, args.filename, args.jobs, args.cache, args.dedup_index)
+    else:
+        generate_filelist(args.path, args.recursive, args.filename, args.jobs, args.dedup_index)
@@ -1,71 +1,208 @@
+import os
 import json
+import html
 import yaml
-import os
+import hashlib
+import inspect
+import argparse
+import filelist_state
+from attempt_history import is_successful_upload
+from generate_report import summarize_attempts
+
+# Files listed per page
+DEFAULT_PAGE_SIZE = 1000
+
+# Sort orders, each written as its own set of pages: (name, link text, sort key, newest/largest first)
+SORTS = [
+    ('name', 'name', lambda row: (row[0].lower(), row[0]), False),
+    ('size', 'size', lambda row: row[2], True),
+    ('date', 'upload date', lambda row: row[3], True),
+]
+
+# Searches search.js in the browser, loading it on the first keystroke. A script tag, unlike fetch(),
+# also works when the pages are opened from disk (file://)
+SEARCH_SCRIPT = """<script>
+let searchLoading = null;
+function loadSearchIndex() {
+  if (!searchLoading) {
+    searchLoading = new Promise((resolve, reject) => {
+      const script = document.createElement('script');
+      script.src = 'search.js';
+      script.onload = resolve;
+      script.onerror = reject;
+      document.head.append(script);
+    });
+  }
+  return searchLoading;
+}
+async function searchFiles(query) {
+  const results = document.getElementById('results');
+  query = query.trim().toLowerCase();
+  if (query) await loadSearchIndex();
+  results.replaceChildren();
+  if (!query) return;
+  const searchIndex = window.SEARCH_INDEX;
+  for (const [name, reference, size] of searchIndex.files.filter(f => f[0].toLowerCase().includes(query)).slice(0, 100)) {
+    const row = results.insertRow();
+    const link = document.createElement('a');
+    link.href = searchIndex.gateway + reference;
+    link.textContent = name;
+    row.insertCell().append(link);
+    row.insertCell().textContent = (size / 1048576).toFixed(2);
+  }
+}
+</script>"""
 
 def load_settings(settings_path):
     with open(settings_path, 'r') as f:
         return yaml.safe_load(f)
 
-def load_filelist(filelist_path):
-    with open(filelist_path, 'r') as f:
-        return json.load(f)
-
 def load_text_from_file(file_path):
     with open(file_path, 'r') as f:
         return f.read()
 
-def generate_html(settings, file_list):
-    html = []
-    html.append(f"<html>")
-    html.append(f"<head>")
-    html.append(f"<title>{settings['page_title']}</title>")
-    html.append(f"</head>")
-    html.append(f"<body>")
-    html.append(f"<h1>{settings['page_title']}</h1>")  # Add this line for the title at the top of the page
-    html.append(f"<table>")
-    
-    # Add placeholder text from settings
-    placeholder_text = settings.get('placeholder_text', 'Default placeholder text if not specified in settings')
-    html.append(f"<p>{placeholder_text}</p>")  # Add this line for the placeholder text
-   
-    if settings.get('page_css_styles'):
-        css_content = load_text_from_file(settings['page_css_styles'])
-        html.append(f"<style>{css_content}</style>")
-    
-    html.append(f"</head>")
-    html.append(f"<body>")
-    html.append(f"<table>")
-    html.append(f"<tr><th>File Name</th><th>Swarm Reference Hash</th><th>Size in MB</th></tr>")
-    
-    for file_info in file_list:
-        if 'swarmHash' in file_info:
-            file_size_MB = round(file_info['size'] / (1024 * 1024), 2)
-            html.append(f"<tr>")
-            html.append(f"<td>{file_info['filename']}</td>")
-            html.append(f'<td><a href="{settings["swarm_gateway"]}{file_info["swarmHash"]}">{file_info["swarmHash"]}</a></td>')
-            html.append(f"<td>{file_size_MB}</td>")
-            html.append(f"</tr>")
-    
-    html.append(f"</table>")
-    
-    if settings.get('page_footer'):
-        footer_content = load_text_from_file(settings['page_footer'])
-        html.append(f"<br><div>{footer_content}</div>")
-    
-    html.append(f"</body>")
-    html.append(f"</html>")
-    
-    return '\n'.join(html)
+def iter_rows(file_infos):
+    """Reduce uploaded filelist entries to (filename, swarmHash, size, last upload) rows."""
+    for file_info in file_infos:
+        if 'swarmHash' not in file_info or file_info.get('removed'):
+            continue
+        _, _, last_uploaded, _ = summarize_attempts(file_info.get('upload_attempts', []), is_successful_upload,
+                                                    file_info.get('upload_attempts_summary'))
+        yield file_info['filename'], file_info['swarmHash'], file_info['size'], last_uploaded
 
-if __name__ == '__main__':
-    settings = load_settings('settings.yaml')
-    file_list = load_filelist(settings['file_info_path'])
-    html_content = generate_html(settings, file_list)
+def page_filename(sort, number):
+    return 'index.html' if sort == 'name' and number == 1 else f"{sort}-{number}.html"
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+def render_navigation(sort, number, page_count):
+    links = [f'Sort by: ' + ' | '.join(
+        f'<b>{label}</b>' if name == sort else f'<a href="{page_filename(name, 1)}">{label}</a>'
+        for name, label, _, _ in SORTS)]
+    pages = []
+    if number > 1:
+        pages.append(f'<a href="{page_filename(sort, 1)}">first</a>')
+        pages.append(f'<a href="{page_filename(sort, number - 1)}">previous</a>')
+    pages.append(f"page {number} of {page_count}")
+    if number < page_count:
+        pages.append(f'<a href="{page_filename(sort, number + 1)}">next</a>')
+        pages.append(f'<a href="{page_filename(sort, page_count)}">last</a>')
+    links.append(' | '.join(pages))
+    return f"<p>{'<br>'.join(links)}</p>"
+
+def render_page(settings, layout, sort, number, page_count, rows):
+    title = html.escape(settings['page_title'])
+    gateway = settings['swarm_gateway']
+    navigation = render_navigation(sort, number, page_count)
+    parts = [
+        "<html>",
+        "<head>",
+        f"<title>{title}</title>",
+        '<link rel="stylesheet" href="styles.css">' if layout['css'] else "",
+        "</head>",
+        "<body>",
+        f"<h1>{title}</h1>",
+        f"<p>{settings.get('placeholder_text', 'Default placeholder text if not specified in settings')}</p>",
+        '<p><input type="search" placeholder="Search file names" oninput="searchFiles(this.value)"></p>',
+        '<table id="results"></table>',
+        navigation,
+        "<table>",
+        "<tr><th>File Name</th><th>Swarm Reference Hash</th><th>Size in MB</th><th>Uploaded</th></tr>",
+    ]
+    for filename, swarm_hash, size, uploaded in rows:
+        parts.append(f'<tr><td>{html.escape(filename)}</td>'
+                     f'<td><a href="{html.escape(gateway + swarm_hash)}">{html.escape(swarm_hash)}</a></td>'
+                     f'<td>{round(size / (1024 * 1024), 2)}</td><td>{uploaded}</td></tr>')
+    parts.append("</table>")
+    parts.append(navigation)
+    if layout['footer']:
+        parts.append(f"<br><div>{layout['footer']}</div>")
+    parts.append(SEARCH_SCRIPT)
+    parts.append("</body>")
+    parts.append("</html>")
+    return '\n'.join(part for part in parts if part)
 
-    # Replace spaces in page_title with underscores and append .html
-    output_file_name = f"{settings['page_title'].replace(' ', '_')}.html"
-    
-    with open(output_file_name, 'w') as f:
-        f.write(html_content)
+def write_if_changed(output_dir, filename, content_fingerprint, render, manifest, new_manifest):
+    """Write `render()` to the file unless the manifest shows it already holds that content.
+
+    Returns True when the file was written.
+    """
+    path = os.path.join(output_dir, filename)
+    new_manifest[filename] = content_fingerprint
+    if manifest.get(filename) == content_fingerprint and os.path.exists(path):
+        return False
+    with open(path, 'w') as f:
+        f.write(render())
+    return True
+
+def generate_html_pages(settings, file_infos, output_dir, page_size=DEFAULT_PAGE_SIZE):
+    """Write the file listing as pages of `page_size` rows per sort order, plus search.js.
+
+    Only the rows are kept in memory, not the filelist entries. A page is only
+    rendered and written when its rows or the page layout changed since the
+    last run, as recorded in manifest.json.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    new_manifest = {}
+
+    rows = list(iter_rows(file_infos))
+    layout = {
+        'css': load_text_from_file(settings['page_css_styles']) if settings.get('page_css_styles') else '',
+        'footer': load_text_from_file(settings['page_footer']) if settings.get('page_footer') else '',
+    }
+    # The template is the rendering code itself, so editing it also renders every page again
+    template = SEARCH_SCRIPT + inspect.getsource(render_page) + inspect.getsource(render_navigation)
+    layout_fingerprint = fingerprint(settings['page_title'], settings.get('placeholder_text'),
+                                     settings['swarm_gateway'], bool(layout['css']), layout['footer'],
+                                     template, [(name, label) for name, label, _, _ in SORTS])
+
+    written = 0
+    if layout['css']:
+        written += write_if_changed(output_dir, 'styles.css', fingerprint(layout['css']), lambda: layout['css'],
+                                    manifest, new_manifest)
+    search_index = "window.SEARCH_INDEX = " + json.dumps(
+        {"gateway": settings['swarm_gateway'], "fields": ["name", "reference", "size", "uploaded"],
+         "files": sorted(rows)}, separators=(',', ':')) + ";\n"
+    written += write_if_changed(output_dir, 'search.js', fingerprint(search_index), lambda: search_index,
+                                manifest, new_manifest)
+
+    page_count = max(1, -(-len(rows) // page_size))
+    pages = 0
+    for sort, _, key, descending in SORTS:
+        rows.sort(key=key, reverse=descending)
+        for number in range(1, page_count + 1):
+            page_rows = rows[(number - 1) * page_size:number * page_size]
+            page_fingerprint = fingerprint(layout_fingerprint, sort, number, page_count, page_rows)
+            written += write_if_changed(
+                output_dir, page_filename(sort, number), page_fingerprint,
+                lambda: render_page(settings, layout, sort, number, page_count, page_rows), manifest, new_manifest)
+            pages += 1
+
+    # Pages beyond the new last page are left over from a longer listing
+    for filename in manifest:
+        if filename not in new_manifest and os.path.exists(os.path.join(output_dir, filename)):
+            os.remove(os.path.join(output_dir, filename))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(new_manifest, f, indent=4)
+    print(f"Listed {len(rows)} files on {pages} pages in {output_dir}, {written} files written.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate HTML pages listing the uploaded files.')
+    parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
+    parser.add_argument('-F', '--filelist', help='Path to filelist JSON file', default=None)
+    args = parser.parse_args()
 
+    settings = load_settings(args.settings)
+    # Entries are read one at a time, including updates still held in the journal of a running upload
+    file_infos = filelist_state.iter_filelist(args.filelist or settings['file_info_path'])
 
+    # Replace spaces in page_title with underscores for the output folder
+    output_dir = settings.get('html_output_dir') or settings['page_title'].replace(' ', '_')
+    generate_html_pages(settings, file_infos, output_dir, settings.get('html_page_size', DEFAULT_PAGE_SIZE))
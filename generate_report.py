@@ -1,8 +1,22 @@
 import json
+import math
 import yaml
+import filelist_state
+from transfer_metrics import attempt_speed_MBps
+from attempt_history import SUMMARY_KEYS, is_successful_upload, is_successful_download, measures_speed
 import csv
 import argparse
-from datetime import datetime
+
+# Upper bounds of the file size buckets used by the aggregate statistics
+SIZE_BUCKETS = [
+    (64 * 1024, '<64KB'),
+    (1024 * 1024, '64KB-1MB'),
+    (16 * 1024 * 1024, '1MB-16MB'),
+    (256 * 1024 * 1024, '16MB-256MB'),
+    (float('inf'), '>=256MB'),
+]
+
+PERCENTILES = (50, 95, 99)
 
 
 def load_settings(settings_path):
@@ -10,22 +24,50 @@ def load_settings(settings_path):
         return yaml.safe_load(f)
 
 def load_filelist(filelist_path):
-    with open(filelist_path, 'r') as f:
-        return json.load(f)
+    # Includes updates still held in the journal of a running or interrupted upload/download
+    return filelist_state.load_filelist(filelist_path)
 
 
-def calculate_speed_MBps(timestamp_start, timestamp_end, file_size_bytes):
-    if not timestamp_start or not timestamp_end:
+def calculate_speed_MBps(attempt, file_size_bytes):
+    if not attempt:
         return ''
-    FMT = '%Y-%m-%d %H:%M:%S'
-    tdelta = datetime.strptime(timestamp_end, FMT) - datetime.strptime(timestamp_start, FMT)
-    duration_seconds = tdelta.total_seconds()
-    if duration_seconds == 0:
+    if attempt.get('probe') == 'head':
+        return "Head probe"
+    if attempt.get('deduplicated'):
+        return "Deduplicated"
+    speed = attempt_speed_MBps(attempt, file_size_bytes)
+    if speed is None:
         return "Infinite"
-    file_size_MB = file_size_bytes / (1024 * 1024)
-    return round(file_size_MB / duration_seconds, 2)
+    return round(speed, 2)
+
+def summarize_attempts(attempts, is_successful, summary=None):
+    """Return (successful count, first end, last end, last successful attempt) in one pass.
+
+    `summary` holds the attempts rolled up by attempt_history; they count, but
+    only the raw attempts can be the last successful attempt.
+    """
+    count, first_end, last_end, last_attempt = 0, '', '', None
+    if summary:
+        count = summary['successes']
+        first_end = summary['first_success'] or ''
+        last_end = summary['last_success'] or ''
+    for attempt in attempts:
+        if not is_successful(attempt):
+            continue
+        count += 1
+        timestamp_end = attempt.get('timestamp_end', '')
+        if not first_end or timestamp_end < first_end:
+            first_end = timestamp_end
+        if last_attempt is None or timestamp_end > last_end:
+            last_end, last_attempt = timestamp_end, attempt
+    return count, first_end, last_end, last_attempt
+
+def generate_csv_report(file_list, output_path, stats=None):
+    """Write one CSV row per file. `file_list` may be any iterable, e.g. filelist_state.iter_filelist().
 
-def generate_csv_report(file_list, output_path):
+    When `stats` is given, every entry is also added to it, so the aggregate
+    statistics are computed in the same pass.
+    """
     with open(output_path, 'w', newline='') as csvfile:
         fieldnames = ['filename', 'size in bytes', 'swarmHash', 'first uploaded', 'last uploaded', 
                       'last successful download', 'number of times successfully downloaded', 
@@ -34,41 +76,231 @@ def generate_csv_report(file_list, output_path):
         writer.writeheader()
         
         for file_info in file_list:
-            successful_uploads = [attempt for attempt in file_info.get('upload_attempts', []) if 'error' not in attempt]
-            successful_downloads = [attempt for attempt in file_info.get('download_attempts', []) if attempt.get('sha256_comparison') == 'Successful']
+            _, first_uploaded, last_uploaded, last_successful_upload = summarize_attempts(
+                file_info.get('upload_attempts', []), is_successful_upload, file_info.get('upload_attempts_summary'))
+            downloads_count, _, last_downloaded, last_successful_download = summarize_attempts(
+                file_info.get('download_attempts', []), is_successful_download,
+                file_info.get('download_attempts_summary'))
 
-            last_successful_upload = max(successful_uploads, key=lambda x: x.get('timestamp_end', ''), default=None)
-            last_successful_download = max(successful_downloads, key=lambda x: x.get('timestamp_end', ''), default=None)
-
-            last_upload_speed = calculate_speed_MBps(
-                last_successful_upload.get('timestamp_start', '') if last_successful_upload else '',
-                last_successful_upload.get('timestamp_end', '') if last_successful_upload else '',
-                file_info.get('size', 0)
-            )
-
-            last_download_speed = calculate_speed_MBps(
-                last_successful_download.get('timestamp_start', '') if last_successful_download else '',
-                last_successful_download.get('timestamp_end', '') if last_successful_download else '',
-                file_info.get('size', 0)
-            )
+            last_upload_speed = calculate_speed_MBps(last_successful_upload, file_info.get('size', 0))
+            last_download_speed = calculate_speed_MBps(last_successful_download, file_info.get('size', 0))
 
             writer.writerow({
                 'filename': file_info.get('filename', ''),
                 'size in bytes': file_info.get('size', ''),
                 'swarmHash': file_info.get('swarmHash', ''),
-                'first uploaded': min([x.get('timestamp_end', '') for x in successful_uploads], default=''),
-                'last uploaded': max([x.get('timestamp_end', '') for x in successful_uploads], default=''),
-                'last successful download': max([x.get('timestamp_end', '') for x in successful_downloads], default=''),
-                'number of times successfully downloaded': len(successful_downloads),
+                'first uploaded': first_uploaded,
+                'last uploaded': last_uploaded,
+                'last successful download': last_downloaded,
+                'number of times successfully downloaded': downloads_count,
                 'last successful download speed (MB/s)': last_download_speed,
                 'last successful upload speed (MB/s)': last_upload_speed
             })
 
+            if stats is not None:
+                stats.add_file(file_info)
+
+
+class LogHistogram:
+    """Histogram with logarithmic buckets for approximate percentiles in bounded memory.
+
+    Each bucket spans a factor of `growth`, so percentiles are accurate to about
+    half of that (1% for the default) no matter how many values are added.
+    """
+
+    def __init__(self, growth=1.02):
+        self.log_growth = math.log(growth)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value is None:
+            return
+        index = math.floor(math.log(value) / self.log_growth) if value > 0 else None
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = math.ceil(q / 100 * self.count)
+        seen = 0
+        for index in sorted(self.buckets, key=lambda i: float('-inf') if i is None else i):
+            seen += self.buckets[index]
+            if seen >= rank:
+                if index is None:
+                    return 0.0
+                # Geometric middle of the bucket, clamped to the values actually seen
+                return min(max(math.exp((index + 0.5) * self.log_growth), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+        }
+        for q in PERCENTILES:
+            summary[f'p{q}'] = self.percentile(q)
+        return summary
+
+
+class AttemptGroup:
+    """Success counts and throughput/latency histograms for one direction and size bucket.
+
+    Attempts rolled up into per-file summaries count towards the attempts and
+    successes; their speeds only survive as count, min, max and mean, so they
+    are kept apart from the histograms.
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.deduplicated = 0
+        self.histograms = {'throughput_MBps': LogHistogram(), 'duration_s': LogHistogram(), 'ttfb_s': LogHistogram()}
+        self.rolled_up = {'attempts': 0, 'successes': 0,
+                          'throughput_MBps': {'count': 0, 'mean': None, 'min': None, 'max': None}}
+
+    def add_summary(self, summary):
+        self.attempts += summary['attempts']
+        self.successes += summary['successes']
+        self.rolled_up['attempts'] += summary['attempts']
+        self.rolled_up['successes'] += summary['successes']
+        speed, total = summary['speed_MBps'], self.rolled_up['throughput_MBps']
+        if not speed['count']:
+            return
+        count = total['count'] + speed['count']
+        total['mean'] = ((total['mean'] or 0) * total['count'] + speed['mean'] * speed['count']) / count
+        total['min'] = speed['min'] if total['min'] is None else min(total['min'], speed['min'])
+        total['max'] = speed['max'] if total['max'] is None else max(total['max'], speed['max'])
+        total['count'] = count
+
+    def add(self, attempt, successful, file_size_bytes):
+        self.attempts += 1
+        if not successful:
+            return
+        self.successes += 1
+        # A deduplicated upload reused a reference without transferring anything
+        if attempt.get('deduplicated'):
+            self.deduplicated += 1
+            return
+        metrics = attempt.get('metrics') or {}
+        # A "head" probe fetches only the first bytes: its time to first byte counts, its speed and duration do not
+        if measures_speed(attempt):
+            self.histograms['throughput_MBps'].add(attempt_speed_MBps(attempt, file_size_bytes))
+            self.histograms['duration_s'].add(metrics.get('duration_s'))
+        self.histograms['ttfb_s'].add(metrics.get('ttfb_s'))
+
+    def summary(self):
+        return {
+            'attempts': self.attempts,
+            'successes': self.successes,
+            'success_rate': self.successes / self.attempts if self.attempts else None,
+            'deduplicated': self.deduplicated,
+            'metrics': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            'rolled_up': self.rolled_up,
+        }
+
+
+def size_bucket(file_size_bytes):
+    for upper_bound, label in SIZE_BUCKETS:
+        if file_size_bytes < upper_bound:
+            return label
+
+
+class ReportStats:
+    """Aggregate upload and download statistics, fed one filelist entry at a time.
+
+    Rolled-up attempts have no timestamps of their own, so they are left out of the timeline.
+    """
+
+    DIRECTIONS = (('upload', 'upload_attempts', is_successful_upload),
+                  ('download', 'download_attempts', is_successful_download))
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.groups = {(direction, bucket): AttemptGroup()
+                       for direction, _, _ in self.DIRECTIONS
+                       for bucket in ['all'] + [label for _, label in SIZE_BUCKETS]}
+        # Attempts and successes per direction and hour, keyed by "YYYY-MM-DD HH"
+        self.timeline = {}
+
+    def add_file(self, file_info):
+        file_size_bytes = file_info.get('size', 0)
+        bucket = size_bucket(file_size_bytes)
+        self.files += 1
+        self.bytes += file_size_bytes
+        for direction, key, is_successful in self.DIRECTIONS:
+            summary = file_info.get(SUMMARY_KEYS[key])
+            if summary:
+                self.groups[(direction, 'all')].add_summary(summary)
+                self.groups[(direction, bucket)].add_summary(summary)
+            for attempt in file_info.get(key, []):
+                successful = is_successful(attempt)
+                self.groups[(direction, 'all')].add(attempt, successful, file_size_bytes)
+                self.groups[(direction, bucket)].add(attempt, successful, file_size_bytes)
+                hour = attempt.get('timestamp_start', '')[:13]
+                counts = self.timeline.setdefault((direction, hour), [0, 0])
+                counts[0] += 1
+                counts[1] += successful
+
+    def to_dict(self):
+        comparison = {}
+        for bucket in ['all'] + [label for _, label in SIZE_BUCKETS]:
+            upload = self.groups[('upload', bucket)].histograms['throughput_MBps'].percentile(50)
+            download = self.groups[('download', bucket)].histograms['throughput_MBps'].percentile(50)
+            comparison[bucket] = {
+                'upload_p50_MBps': upload,
+                'download_p50_MBps': download,
+                'download_to_upload_ratio': download / upload if upload and download is not None else None,
+            }
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'groups': {f'{direction}/{bucket}': group.summary() for (direction, bucket), group in self.groups.items()},
+            'upload_vs_download': comparison,
+            'timeline': [{'direction': direction, 'hour': hour, 'attempts': attempts, 'successes': successes,
+                          'success_rate': successes / attempts}
+                         for (direction, hour), (attempts, successes) in sorted(self.timeline.items())],
+        }
+
+    def write(self, json_path, csv_path, timeline_csv_path):
+        stats = self.to_dict()
+        with open(json_path, 'w') as f:
+            json.dump(stats, f, indent=4)
+
+        with open(csv_path, 'w', newline='') as csvfile:
+            fieldnames = ['direction', 'size bucket', 'attempts', 'successes', 'success rate', 'metric', 'count',
+                          'mean', 'min'] + [f'p{q}' for q in PERCENTILES] + ['max']
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for (direction, bucket), group in self.groups.items():
+                summary = group.summary()
+                for metric, values in summary['metrics'].items():
+                    writer.writerow({'direction': direction, 'size bucket': bucket, 'attempts': summary['attempts'],
+                                     'successes': summary['successes'], 'success rate': summary['success_rate'],
+                                     'metric': metric, **values})
+
+        with open(timeline_csv_path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=['direction', 'hour', 'attempts', 'successes', 'success_rate'])
+            writer.writeheader()
+            writer.writerows(stats['timeline'])
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate CSV report.')
     parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
     parser.add_argument('-F', '--filelist', help='Path to filelist JSON file', default=None)
+    parser.add_argument('-A', '--aggregate', action='store_true',
+                        help='Also write aggregate statistics to report_stats.json, report_stats.csv and report_timeline.csv')
     args = parser.parse_args()
 
     if args.filelist:
@@ -79,10 +311,16 @@ if __name__ == '__main__':
     
     print(f"Generating report based on {filelist_path}.")
     
-    file_list = load_filelist(filelist_path)
+    # Entries are read one at a time so memory does not grow with the filelist
+    file_list = filelist_state.iter_filelist(filelist_path)
+    stats = ReportStats() if args.aggregate else None
     
     output_path = 'report.csv'
-    generate_csv_report(file_list, output_path)
+    generate_csv_report(file_list, output_path, stats)
     
     print(f"Report successfully generated and saved as {output_path}.")
 
+    if stats is not None:
+        stats.write('report_stats.json', 'report_stats.csv', 'report_timeline.csv')
+        print("Aggregate statistics saved as report_stats.json, report_stats.csv and report_timeline.csv.")
+
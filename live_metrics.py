@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import os
+import json
+import math
+import time
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_METRICS_INTERVAL = 5.0
+
+# Windows in seconds of the throughput moving averages
+THROUGHPUT_WINDOWS = {'1m': 60, '5m': 300, '15m': 900}
+
+METRIC_PREFIX = 'swarm_transfer'
+
+
+class StageMetrics:
+    """Counters of one transfer stage (upload, download, ...).
+
+    `record()` is all the hot loop calls: it only adds to a few counters under a
+    lock. Moving averages and the ETA are worked out on the publishing thread.
+    """
+
+    def __init__(self, stage, nodes=None, total_files=None, total_bytes=None):
+        self.stage = stage
+        self.nodes = nodes or []
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files_done = 0
+        self.files_skipped = 0
+        self.bytes_done = 0
+        self.errors = 0
+        self.last_progress = time.monotonic()
+        self.throughput = {window: 0.0 for window in THROUGHPUT_WINDOWS}
+        self._lock = threading.Lock()
+        self._started = self._ticked_at = time.monotonic()
+        self._ticked_bytes = 0
+
+    def record(self, succeeded, transferred_bytes=0):
+        with self._lock:
+            if succeeded:
+                self.files_done += 1
+                self.bytes_done += transferred_bytes
+                self.last_progress = time.monotonic()
+            else:
+                self.errors += 1
+
+    def skip(self, file_bytes=0):
+        """Count a file that needed no transfer (deduplicated): it is done, but its bytes leave the total
+        instead of counting towards the throughput."""
+        with self._lock:
+            self.files_done += 1
+            self.files_skipped += 1
+            self.last_progress = time.monotonic()
+            if self.total_bytes is not None:
+                self.total_bytes -= file_bytes
+
+    def tick(self):
+        """Update the moving averages with the bytes done since the last tick."""
+        now = time.monotonic()
+        with self._lock:
+            bytes_done = self.bytes_done
+        elapsed = now - self._ticked_at
+        if elapsed <= 0:
+            return
+        rate = (bytes_done - self._ticked_bytes) / elapsed
+        for window, seconds in THROUGHPUT_WINDOWS.items():
+            self.throughput[window] += (1 - math.exp(-elapsed / seconds)) * (rate - self.throughput[window])
+        self._ticked_at = now
+        self._ticked_bytes = bytes_done
+
+    def moving_averages(self):
+        """Return the moving averages, corrected for starting from zero (as in Adam's bias correction)."""
+        observed = self._ticked_at - self._started
+        return {window: rate / (1 - math.exp(-observed / THROUGHPUT_WINDOWS[window])) if observed > 0 else 0.0
+                for window, rate in self.throughput.items()}
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "stage": self.stage,
+                "files_done": self.files_done,
+                "files_skipped": self.files_skipped,
+                "bytes_done": self.bytes_done,
+                "errors": self.errors,
+                "bytes_total": self.total_bytes,
+            }
+        snapshot["files_total"] = self.total_files
+        snapshot["in_flight"] = sum(node.in_flight for node in self.nodes)
+        snapshot["retries"] = sum(node.controller.retries for node in self.nodes)
+        snapshot["concurrency_limit"] = sum(node.controller.limit for node in self.nodes)
+        snapshot["seconds_since_progress"] = round(time.monotonic() - self.last_progress, 3)
+        throughput = self.moving_averages()
+        snapshot["throughput_bytes_per_s"] = {window: round(rate, 1) for window, rate in throughput.items()}
+        rate = throughput['1m']
+        if self.total_bytes is not None and rate > 0:
+            snapshot["eta_s"] = round(max(0, self.total_bytes - snapshot["bytes_done"]) / rate, 1)
+        else:
+            snapshot["eta_s"] = None
+        return snapshot
+
+
+def format_openmetrics(snapshots):
+    """Render stage snapshots in the Prometheus/OpenMetrics text format."""
+    metrics = [
+        ('files_done', 'files_done', 'counter', 'Files done successfully, including skipped ones'),
+        ('files_skipped', 'files_skipped', 'counter', 'Files that needed no transfer (deduplicated)'),
+        ('bytes_done', 'bytes_done', 'counter', 'Bytes transferred successfully'),
+        ('errors', 'errors', 'counter', 'Failed transfer attempts'),
+        ('retries', 'retries', 'counter', 'Transfer retries scheduled'),
+        ('files_total', 'files', 'gauge', 'Files selected for transfer'),
+        ('bytes_total', 'bytes', 'gauge', 'Bytes selected for transfer'),
+        ('in_flight', 'in_flight', 'gauge', 'Transfers currently running'),
+        ('concurrency_limit', 'concurrency_limit', 'gauge', 'Transfers allowed to run at once'),
+        ('seconds_since_progress', 'seconds_since_progress', 'gauge', 'Seconds since the last successful transfer'),
+        ('eta_s', 'eta_seconds', 'gauge', 'Estimated seconds until all selected bytes are transferred'),
+    ]
+    lines = []
+    for key, metric_name, metric_type, help_text in metrics:
+        name = f"{METRIC_PREFIX}_{metric_name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for snapshot in snapshots:
+            if snapshot[key] is not None:
+                sample_name = f"{name}_total" if metric_type == 'counter' else name
+                lines.append(f'{sample_name}{{stage="{snapshot["stage"]}"}} {snapshot[key]}')
+    name = f"{METRIC_PREFIX}_throughput_bytes_per_second"
+    lines.append(f"# HELP {name} Moving average of the transfer throughput")
+    lines.append(f"# TYPE {name} gauge")
+    for snapshot in snapshots:
+        for window, rate in snapshot["throughput_bytes_per_s"].items():
+            lines.append(f'{name}{{stage="{snapshot["stage"]}",window="{window}"}} {rate}')
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class LiveMetrics:
+    """Publishes the metrics of all stages while a run is in progress.
+
+    Every `interval` seconds a background thread updates the moving averages
+    and, with `metrics_file` set, atomically rewrites that file as JSON. With
+    `port` set, an HTTP server answers GET /metrics in the OpenMetrics text format.
+    """
+
+    def __init__(self, interval=DEFAULT_METRICS_INTERVAL, metrics_file=None, port=None, host='127.0.0.1'):
+        self.interval = interval
+        self.metrics_file = metrics_file
+        self.stages = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='live-metrics', daemon=True)
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.live_metrics = self
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+            print(f"Metrics available on http://{host}:{self.server.server_port}/metrics")
+
+    def add_stage(self, stage, nodes=None, total_files=None, total_bytes=None):
+        stage_metrics = StageMetrics(stage, nodes, total_files, total_bytes)
+        self.stages.append(stage_metrics)
+        return stage_metrics
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def snapshots(self):
+        return [stage.snapshot() for stage in self.stages]
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.publish()
+
+    def publish(self):
+        for stage in self.stages:
+            stage.tick()
+        if self.metrics_file:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.metrics_file)),
+                                             delete=False) as tempf:
+                json.dump({"time": time.time(), "stages": self.snapshots()}, tempf, indent=4)
+            os.replace(tempf.name, self.metrics_file)
+
+    def stop(self):
+        """Publish the final numbers and stop the background thread and the HTTP server."""
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.publish()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = format_openmetrics(self.server.live_metrics.snapshots()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_live_metrics(settings):
+    """Start LiveMetrics as configured by metrics_port and metrics_file, or return None when both are off."""
+    port = settings.get('metrics_port')
+    metrics_file = settings.get('metrics_file')
+    if not port and not metrics_file:
+        return None
+    return LiveMetrics(settings.get('metrics_interval', DEFAULT_METRICS_INTERVAL), metrics_file, port,
+                       settings.get('metrics_host', '127.0.0.1')).start()
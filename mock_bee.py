@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import io
+import time
+import random
+import socket
+import tarfile
+import hashlib
+import argparse
+import threading
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Size of the blocks in which request and response bodies are throttled
+THROTTLE_BLOCK_SIZE = 64 * 1024
+
+
+class MockBeeState:
+    """Content stored by the mock and counters of the work it did."""
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth  # Bytes per second per connection, None for unlimited
+        self.error_rate = error_rate  # Share of /bzz requests answered with 500
+        self.store = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.busy_seconds = 0.0
+
+    def add_busy(self, seconds):
+        with self.lock:
+            self.requests += 1
+            self.busy_seconds += seconds
+
+
+class MockBeeHandler(BaseHTTPRequestHandler):
+    """Implements the parts of the Bee /bzz API used by this tool.
+
+    References are the SHA-256 of the uploaded content, so they are 64 hex
+    characters like real Swarm references and the same content maps to the same
+    reference. Tar collections (Swarm-Collection: true) are unpacked so their
+    files can be fetched as /bzz/<reference>/<path>. Downloads honour a single
+    "bytes=first-last" Range header.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def bee(self):
+        return self.server.bee
+
+    def _throttle(self, started, transferred):
+        if self.bee.bandwidth:
+            delay = started + transferred / self.bee.bandwidth - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _read_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        started = time.perf_counter()
+        chunks = []
+        received = 0
+        while remaining:
+            chunk = self.rfile.read(min(remaining, THROTTLE_BLOCK_SIZE))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+            remaining -= len(chunk)
+            self._throttle(started, received)
+        return b''.join(chunks)
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        started = time.perf_counter()
+        for offset in range(0, len(body), THROTTLE_BLOCK_SIZE):
+            self.wfile.write(body[offset:offset + THROTTLE_BLOCK_SIZE])
+            self._throttle(started, offset + THROTTLE_BLOCK_SIZE)
+
+    def do_POST(self):
+        started = time.perf_counter()
+        if not self.path.startswith('/bzz'):
+            self._send(404, b'{"message": "Not Found"}')
+            return
+        if not self.headers.get('Swarm-Postage-Batch-Id'):
+            self._read_body()
+            self._send(400, b'{"message": "invalid postage batch id"}')
+            return
+        body = self._read_body()
+        time.sleep(self.bee.latency)
+        if random.random() < self.bee.error_rate:
+            self._send(500, b'{"message": "Internal Server Error"}')
+            self.bee.add_busy(time.perf_counter() - started)
+            return
+        reference = hashlib.sha256(body).hexdigest()
+        if self.headers.get('Swarm-Collection', '').lower() == 'true':
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                files = {member.name: tar.extractfile(member).read() for member in tar.getmembers() if member.isfile()}
+            with self.bee.lock:
+                self.bee.store.update({f"{reference}/{path}": content for path, content in files.items()})
+        else:
+            with self.bee.lock:
+                self.bee.store[reference] = body
+        self._send(201, f'{{"reference": "{reference}"}}'.encode())
+        self.bee.add_busy(time.perf_counter() - started)
+
+    def do_GET(self):
+        started = time.perf_counter()
+        parts = unquote(self.path.split('?')[0]).strip('/').split('/', 1)
+        if parts[0] == 'health':
+            self._send(200, b'{"status": "ok"}')
+            return
+        body = self.bee.store.get(parts[1]) if parts[0] == 'bzz' and len(parts) > 1 else None
+        time.sleep(self.bee.latency)
+        if random.random() < self.bee.error_rate:
+            self._send(500, b'{"message": "Internal Server Error"}')
+        elif body is None:
+            self._send(404, b'{"message": "Not Found"}')
+        elif self.headers.get('Range', '').startswith('bytes='):
+            first, _, last = self.headers['Range'][len('bytes='):].partition('-')
+            first, last = int(first), min(int(last or len(body) - 1), len(body) - 1)
+            self._send(206, body[first:last + 1], content_type='application/octet-stream',
+                       headers={'Content-Range': f"bytes {first}-{last}/{len(body)}"})
+        else:
+            self._send(200, body, content_type='application/octet-stream')
+        self.bee.add_busy(time.perf_counter() - started)
+
+
+def start_mock_bee(host='127.0.0.1', port=0, latency=0.0, bandwidth=None, error_rate=0.0, bee=None):
+    """Start a mock Bee server on a background thread and return it.
+
+    The API endpoint is f"http://{host}:{server.server_port}"; call shutdown() to stop it.
+    Servers given the same `bee` state act as nodes of one network: content
+    uploaded to any of them can be downloaded from all of them.
+    """
+    server = ThreadingHTTPServer((host, port), MockBeeHandler)
+    server.daemon_threads = True
+    server.bee = bee or MockBeeState(latency, bandwidth, error_rate)
+    threading.Thread(target=server.serve_forever, name='mock-bee', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a mock Bee API server for testing and benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=1633, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bytes per second per connection (default: unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with an error')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), MockBeeHandler)
+    server.bee = MockBeeState(args.latency, args.bandwidth, args.error_rate)
+    print(f"Mock Bee listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
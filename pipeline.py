@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+import os
+import time
+import queue
+import argparse
+import threading
+from multiprocessing import Pool
+from generate_filelist import walk_files, describe_file
+from filelist_state import load_filelist, write_filelist_json, apply_update, limit_history
+from upload_files import load_settings, get_upload_nodes, select_files_to_upload, run_uploads
+from download_files import get_download_nodes, run_downloads
+from transfer_controller import STOP_POLL_INTERVAL
+from bee_monitor import start_sampler
+from dedup_index import open_dedup_index
+from live_metrics import start_live_metrics
+
+# Files that may be hashed ahead of the upload stage, and uploads waiting for verification
+DEFAULT_QUEUE_SIZE = 64
+
+# Seconds between saves of the filelist while the pipeline runs
+DEFAULT_SAVE_INTERVAL = 30
+
+# Marks the end of a stage queue
+_DONE = object()
+
+
+class PipelineState:
+    """The filelist shared by the pipeline stages.
+
+    Stages run on their own threads, so every change goes through `add()` or
+    `update()` under one lock. The main thread saves the filelist every
+    `save_interval` seconds and on close, so a crash loses at most that much
+    progress.
+    """
+
+    def __init__(self, filelist_path, save_interval=DEFAULT_SAVE_INTERVAL, history_limit=None):
+        self.filelist_path = filelist_path
+        self.save_interval = save_interval
+        self.history_limit = history_limit
+        self.file_list = load_filelist(filelist_path) if os.path.exists(filelist_path) else []
+        self._by_path = {file_info['full_path']: i for i, file_info in enumerate(self.file_list)}
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+    def add(self, file_info):
+        """Add a freshly hashed file. Returns the entry to upload, or None when its content is already uploaded."""
+        with self._lock:
+            index = self._by_path.get(file_info['full_path'])
+            if index is None:
+                self._by_path[file_info['full_path']] = len(self.file_list)
+                self.file_list.append(file_info)
+                return file_info
+            existing = self.file_list[index]
+            existing.pop('removed', None)
+            if existing['sha256'] == file_info['sha256'] and existing['size'] == file_info['size'] \
+                    and 'swarmHash' in existing:
+                return None
+            existing.update(file_info)
+            existing.pop('swarmHash', None)
+            return existing
+
+    def update(self, file_info, set_fields=None, append_fields=None):
+        with self._lock:
+            apply_update(file_info, set_fields, append_fields)
+            limit_history(file_info, append_fields, self.history_limit)
+
+    def save(self):
+        with self._lock:
+            write_filelist_json(self.file_list, self.filelist_path)
+        self._saved_at = time.monotonic()
+
+    def save_if_due(self):
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def close(self):
+        self.save()
+
+
+def iter_queue(stage_queue, on_take=None):
+    """Yield the items put on a stage queue until the stage before it is done."""
+    while True:
+        item = stage_queue.get()
+        if item is _DONE:
+            return
+        if on_take:
+            on_take()
+        yield item
+
+
+class Pipeline:
+    """Hash, upload and optionally verify files with all stages running at once.
+
+    Hashing runs in `jobs` processes and feeds the upload stage, which feeds
+    the verify stage. At most `queue_size` files are hashed ahead of the uploads
+    and at most `queue_size` uploaded files wait for verification, so a slow
+    stage holds back the ones before it instead of letting memory grow.
+    """
+
+    def __init__(self, settings, state, verify=False, jobs=None, queue_size=DEFAULT_QUEUE_SIZE):
+        self.settings = settings
+        self.state = state
+        self.verify = verify
+        self.jobs = jobs or os.cpu_count() or 1
+        self.bee_sampler = start_sampler(settings)
+        self.upload_nodes = get_upload_nodes(settings, self.bee_sampler)
+        self.download_nodes = get_download_nodes(settings, self.bee_sampler) if verify else []
+        self.dedup_index = open_dedup_index(settings)
+        # Totals are unknown while the folder is still being walked, so there is no ETA
+        self.live_metrics = start_live_metrics(settings)
+        self.stage_metrics = {}
+        if self.live_metrics:
+            self.stage_metrics['hash'] = self.live_metrics.add_stage('hash')
+            self.stage_metrics['upload'] = self.live_metrics.add_stage('upload', self.upload_nodes)
+            if verify:
+                self.stage_metrics['verify'] = self.live_metrics.add_stage('verify', self.download_nodes)
+        self._hash_slots = threading.BoundedSemaphore(queue_size)
+        self._upload_queue = queue.Queue()
+        self._verify_queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.errors = []
+        self.counts = {'hashed': 0, 'unchanged': 0, 'uploaded': 0, 'deduplicated': 0, 'upload_failed': 0,
+                       'verified': 0, 'verify_failed': 0, 'sha256_failed': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _record(self, stage, succeeded, transferred_bytes):
+        if stage in self.stage_metrics:
+            self.stage_metrics[stage].record(succeeded, transferred_bytes)
+
+    def _skip(self, stage):
+        if stage in self.stage_metrics:
+            self.stage_metrics[stage].skip()
+
+    def _put(self, stage_queue, item):
+        # Once stopped the next stage takes nothing more, so do not wait for room forever
+        while not self._stop.is_set():
+            try:
+                stage_queue.put(item, timeout=STOP_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _run_stage(self, stage, next_queue):
+        # A failing stage still lets the stages after it finish
+        try:
+            stage()
+        except Exception as e:
+            self.errors.append(e)
+            raise
+        finally:
+            if next_queue is not None:
+                self._put(next_queue, _DONE)
+
+    def _hash_stage(self, folder_path, recursive):
+        def gated_files():
+            for path_and_name in walk_files(folder_path, recursive):
+                while not self._hash_slots.acquire(timeout=STOP_POLL_INTERVAL):
+                    if self._stop.is_set():
+                        return
+                yield path_and_name
+
+        with Pool(self.jobs) as pool:
+            # imap_unordered hands on every file as soon as it is hashed, a large file holds up nothing
+            for file_info in pool.imap_unordered(describe_file, gated_files()):
+                self._count('hashed')
+                self._record('hash', True, file_info['size'])
+                entry = self.state.add(file_info)
+                if entry is None:
+                    self._count('unchanged')
+                    self._hash_slots.release()
+                    continue
+                self._upload_queue.put(entry)
+
+    def _upload_stage(self):
+        def on_attempt(file_info, upload_attempt, swarm_hash):
+            self.state.update(file_info,
+                              set_fields={'swarmHash': swarm_hash} if swarm_hash else None,
+                              append_fields={'upload_attempts': upload_attempt})
+            if upload_attempt.get('deduplicated'):
+                self._skip('upload')
+            else:
+                self._record('upload', "error" not in upload_attempt, file_info['size'])
+            if "error" in upload_attempt:
+                return
+            self._count('deduplicated' if upload_attempt.get('deduplicated') else 'uploaded')
+            if self.verify:
+                self._put(self._verify_queue, (file_info, dict(file_info, swarmHash=swarm_hash)))
+
+        max_file_size = self.settings.get('max_file_size', float('inf'))
+        files = iter_queue(self._upload_queue, on_take=self._hash_slots.release)
+        failed = run_uploads(select_files_to_upload(files, 'all', max_file_size), self.settings,
+                             self.upload_nodes, on_attempt, self.dedup_index, streaming=True, stop=self._stop)
+        with self._lock:
+            self.counts['upload_failed'] += len(failed)
+
+    def _verify_stage(self):
+        originals = {}
+
+        def files_to_verify():
+            for file_info, worker_file_info in iter_queue(self._verify_queue):
+                originals[id(worker_file_info)] = file_info
+                yield worker_file_info
+
+        def on_attempt(worker_file_info, download_attempt):
+            self.state.update(originals[id(worker_file_info)], append_fields={'download_attempts': download_attempt})
+            self._record('verify', not download_attempt.get('error'), worker_file_info['size'])
+            if not download_attempt.get('error'):
+                originals.pop(id(worker_file_info))
+                self._count('verified')
+                if download_attempt.get('sha256_comparison') == 'Failed':
+                    self._count('sha256_failed')
+
+        failed = run_downloads(files_to_verify(), self.settings, self.download_nodes, on_attempt,
+                               streaming=True, stop=self._stop)
+        with self._lock:
+            self.counts['verify_failed'] += len(failed)
+
+    def run(self, folder_path, recursive):
+        """Run all stages and save the filelist periodically until the last stage is done.
+
+        On CTRL-C the upload and verify stages stop starting transfers and record
+        the running ones before KeyboardInterrupt is raised again.
+        """
+        threads = [
+            threading.Thread(target=self._run_stage, name='pipeline-hash', daemon=True,
+                             args=(lambda: self._hash_stage(folder_path, recursive), self._upload_queue)),
+            threading.Thread(target=self._run_stage, name='pipeline-upload', daemon=True,
+                             args=(self._upload_stage, self._verify_queue if self.verify else None)),
+        ]
+        if self.verify:
+            threads.append(threading.Thread(target=self._run_stage, name='pipeline-verify', daemon=True,
+                                            args=(self._verify_stage, None)))
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # After a stage failed the stages before it may wait forever for room in its queue
+                while thread.is_alive() and not self.errors:
+                    thread.join(timeout=1.0)
+                    self.state.save_if_due()
+        except KeyboardInterrupt:
+            self._stop.set()
+            # The hash stage stops once its queue is full, files it still adds are uploaded on the next run
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            if self.dedup_index:
+                self.dedup_index.close()
+            if self.live_metrics:
+                self.live_metrics.stop()
+            if self.bee_sampler:
+                self.bee_sampler.stop()
+        if self.errors:
+            raise self.errors[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hash, upload and verify files in one pass.')
+    parser.add_argument('path', type=str, help='Path to the folder.')
+    parser.add_argument('-R', '--recursive', action='store_true', help='Look into subfolders.')
+    parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
+    parser.add_argument('-F', '--filename', type=str, default=None,
+                        help='Filelist to create or extend (default: file_info_path from the settings).')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of hashing processes (default: number of CPUs).')
+    parser.add_argument('-V', '--verify', action='store_true', help='Download every uploaded file again and check its SHA-256.')
+    args = parser.parse_args()
+
+    settings = load_settings(args.settings)
+    state = PipelineState(args.filename or settings['file_info_path'],
+                          settings.get('pipeline_save_interval', DEFAULT_SAVE_INTERVAL),
+                          settings.get('attempt_history_limit'))
+    pipeline = Pipeline(settings, state, verify=args.verify, jobs=args.jobs,
+                        queue_size=settings.get('pipeline_queue_size', DEFAULT_QUEUE_SIZE))
+    try:
+        pipeline.run(args.path, args.recursive)
+        state.close()
+    except KeyboardInterrupt:
+        print("\nCTRL-C detected. Attempting to save JSON file before exiting.")
+        state.close()
+        print("JSON file saved. Exiting now.")
+
+    counts = pipeline.counts
+    print(f"\nPipeline Summary:")
+    print(f"Hashed: {counts['hashed']} files ({counts['unchanged']} already uploaded)")
+    print(f"Successfully uploaded: {counts['uploaded']} files")
+    print(f"Failed to upload: {counts['upload_failed']} files")
+    print(f"Reused the Swarm reference of identical content: {counts['deduplicated']} files")
+    if args.verify:
+        print(f"Verified: {counts['verified']} files")
+        print(f"Failed to verify: {counts['verify_failed']} files")
+        print(f"SHA-256 comparison failed: {counts['sha256_failed']} files")
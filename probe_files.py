@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import time
+import random
+import argparse
+import threading
+import functools
+from datetime import datetime
+from bee_api import BeeClient
+from filelist_state import open_state
+from transfer_metrics import TransferTimer
+from transfer_controller import nodes_from_settings
+from download_files import load_settings, download_file_http, get_range_executor, run_downloads, SizeMismatchError
+from generate_report import size_bucket
+from live_metrics import start_live_metrics
+
+# Leading bytes fetched by a "head" probe
+DEFAULT_HEAD_BYTES = 64 * 1024
+
+
+class RateLimiter:
+    """Spaces out calls from any number of threads to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def select_probe_sample(file_list, sample_size, strategy='random', seed=None):
+    """Pick up to `sample_size` uploaded files to probe.
+
+    "random" samples uniformly. "stratified" samples every size bucket of the
+    report in proportion to its number of files, with at least one file from
+    each bucket (as far as `sample_size` allows), so rare large files are
+    checked as well.
+    """
+    candidates = [file_info for file_info in file_list if 'swarmHash' in file_info and not file_info.get('removed')]
+    rng = random.Random(seed)
+    if sample_size >= len(candidates):
+        return candidates
+    if strategy == 'random':
+        return rng.sample(candidates, sample_size)
+    if strategy != 'stratified':
+        raise ValueError(f"Unknown probe strategy: {strategy}")
+
+    buckets = {}
+    for file_info in candidates:
+        buckets.setdefault(size_bucket(file_info['size']), []).append(file_info)
+    buckets = list(buckets.values())
+    if sample_size < len(buckets):
+        return [rng.choice(files) for files in rng.sample(buckets, sample_size)]
+
+    # One file per bucket, then the remaining slots in proportion to the files left in each bucket
+    extra = [len(files) - 1 for files in buckets]
+    remaining = sample_size - len(buckets)
+    quotas = [remaining * count / sum(extra) for count in extra]
+    shares = [1 + int(quota) for quota in quotas]
+    # Slots lost to rounding down go to the largest remainders
+    by_remainder = sorted(range(len(buckets)), key=lambda i: quotas[i] - int(quotas[i]), reverse=True)
+    for i in by_remainder[:sample_size - sum(shares)]:
+        shares[i] += 1
+    sample = []
+    for files, share in zip(buckets, shares):
+        sample.extend(rng.sample(files, min(share, len(files))))
+    rng.shuffle(sample)
+    return sample
+
+
+def probe_head(file_info, settings, bee_client):
+    """Fetch only the leading bytes of a file to measure time-to-first-byte; the content is not verified."""
+    timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    length = min(settings.get('probe_head_bytes', DEFAULT_HEAD_BYTES), file_info['size'])
+    timer = TransferTimer()
+    received = 0
+    try:
+        if length:
+            body, total = bee_client.fetch_range(file_info['swarmHash'], 0, length - 1, timer=timer)
+            received = len(body)
+            if total is not None and total != file_info['size']:
+                raise SizeMismatchError(f"Bee reports {total} bytes, expected {file_info['size']}")
+            if received != length:
+                raise SizeMismatchError(f"Received {received} bytes, expected {length}")
+        else:
+            bee_client.open_download(file_info['swarmHash'], timer=timer).read()
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = timer.metrics(received)
+        print(f"Probed: {file_info['filename']}  time to first byte: {metrics['ttfb_s']} s")
+        return {
+            "timestamp_start": timestamp_start,
+            "timestamp_end": timestamp_end,
+            "sha256_comparison": "Not checked",
+            "metrics": metrics,
+            "response_body": "",
+            "error": None
+        }
+    except Exception as e:
+        bee_client.close()
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"Probe failed for: {file_info['filename']}  Error: {e}")
+        return {
+            "timestamp_start": timestamp_start,
+            "timestamp_end": timestamp_end,
+            "sha256_comparison": "Failed",
+            "metrics": timer.metrics(received),
+            "error": str(e)
+        }
+
+
+def get_probe_function(settings, mode, rate_limiter):
+    """Return the probe function for one node: "stream" downloads, hashes and discards, "head" fetches a range."""
+    bee_client = BeeClient(settings.get('bee_api_endpoint'))
+    if mode == 'stream':
+        probe_function = functools.partial(download_file_http, bee_client=bee_client,
+                                           range_executor=get_range_executor(settings))
+    elif mode == 'head':
+        probe_function = functools.partial(probe_head, bee_client=bee_client)
+    else:
+        raise ValueError(f"Unknown probe mode: {mode}")
+
+    def probe(file_info, settings):
+        rate_limiter.wait()
+        attempt = probe_function(file_info, dict(settings, download_discard=True))
+        attempt['probe'] = mode
+        return attempt
+    return probe
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that a sample of uploaded files can still be retrieved.')
+    parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
+    parser.add_argument('-n', '--sample-size', type=int, default=None, help='Number of files to probe')
+    parser.add_argument('--strategy', choices=['random', 'stratified'], default=None, help='How files are sampled')
+    parser.add_argument('--mode', choices=['stream', 'head'], default=None,
+                        help='stream: download, hash and discard; head: fetch only the first bytes')
+    parser.add_argument('--rate', type=float, default=None, help='Maximum probes started per second')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for the sample')
+    args = parser.parse_args()
+
+    settings = load_settings(args.settings)
+    sample_size = args.sample_size if args.sample_size is not None else settings.get('probe_sample_size', 100)
+    strategy = args.strategy or settings.get('probe_strategy', 'random')
+    mode = args.mode or settings.get('probe_mode', 'stream')
+    rate = args.rate if args.rate is not None else settings.get('probe_rate', 1.0)
+
+    state = open_state(settings)
+    sample = select_probe_sample(state.file_list, sample_size, strategy, args.seed)
+    print(f"Probing {len(sample)} files ({strategy} sample, {mode} mode, at most {rate} per second)")
+
+    rate_limiter = RateLimiter(rate)
+    nodes = nodes_from_settings(settings, 'download_concurrency')
+    for node in nodes:
+        node.download_function = get_probe_function(node.settings, mode, rate_limiter)
+
+    live_metrics = start_live_metrics(settings)
+    probe_metrics = None
+    if live_metrics:
+        probe_metrics = live_metrics.add_stage('probe', nodes, len(sample), sum(file_info['size'] for file_info in sample))
+
+    retrievable_count = 0
+    sha256_failed_count = 0
+
+    def record_probe_attempt(file_info, probe_attempt):
+        global retrievable_count, sha256_failed_count
+        state.update(file_info, append_fields={'download_attempts': probe_attempt})
+        if probe_metrics:
+            probe_metrics.record(not probe_attempt.get('error'), probe_attempt['metrics']['bytes'])
+        if not probe_attempt.get('error'):
+            retrievable_count += 1
+            if probe_attempt.get('sha256_comparison') == 'Failed':
+                sha256_failed_count += 1
+
+    try:
+        failed_probes = run_downloads(sample, settings, nodes, record_probe_attempt)
+        state.close()
+        if live_metrics:
+            live_metrics.stop()
+
+        ttfbs = sorted(file_info['download_attempts'][-1]['metrics']['ttfb_s'] for file_info in sample
+                       if not file_info['download_attempts'][-1].get('error')
+                       and file_info['download_attempts'][-1]['metrics'].get('ttfb_s') is not None)
+        print(f"\nProbe Summary:")
+        print(f"Retrievable: {retrievable_count} of {len(sample)} files")
+        print(f"Not retrievable: {len(failed_probes)} files")
+        print(f"SHA-256 comparison failed: {sha256_failed_count} files")
+        if ttfbs:
+            print(f"Time to first byte: median {ttfbs[len(ttfbs) // 2]:.3f} s, max {ttfbs[-1]:.3f} s")
+
+    except KeyboardInterrupt:
+        print("\nCTRL-C detected. Attempting to save JSON file before exiting.")
+        state.close()
+        if live_metrics:
+            live_metrics.stop()
+        print("JSON file saved. Exiting now.")
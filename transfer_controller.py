@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+import time
+import heapq
+import queue
+import random
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Seconds between checks of the `stop` Event of run_on_nodes
+STOP_POLL_INTERVAL = 0.5
+
+
+class RetryBudget:
+    """The retries left for a whole run, shared by the controllers of all its Bee nodes."""
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+
+    def take(self):
+        """Use up one retry, or return False when none are left."""
+        if self.used >= self.total:
+            return False
+        self.used += 1
+        return True
+
+
+class TransferController:
+    """Decides how many transfers may be in flight and whether a failed one is retried.
+
+    With `adaptive` set, the limit is tuned AIMD-style once per window of
+    completed transfers (as many as the current limit): it is halved when the
+    error rate of the window exceeds `error_threshold`, lowered by one when the
+    window's throughput dropped after the last increase, and raised by one
+    otherwise. Failed transfers are retried up to `max_retries` times each, with
+    exponential backoff and full jitter, while the run's `retry_budget` lasts:
+    a number, or a RetryBudget shared with the controllers of other nodes.
+    """
+
+    def __init__(self, concurrency=1, adaptive=False, min_concurrency=1, max_concurrency=16,
+                 max_retries=0, retry_budget=100, backoff_base=1.0, backoff_max=60.0, error_threshold=0.1):
+        self.adaptive = adaptive
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency if adaptive else concurrency)
+        self.limit = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget if isinstance(retry_budget, RetryBudget) else RetryBudget(retry_budget)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.error_threshold = error_threshold
+        self.retries = 0
+        self._window_started = time.perf_counter()
+        self._window_done = 0
+        self._window_errors = 0
+        self._window_bytes = 0
+        self._last_throughput = None
+        self._last_change = 0
+
+    def record(self, succeeded, transferred_bytes):
+        """Account one finished transfer and adapt the limit at the end of a window."""
+        self._window_done += 1
+        self._window_errors += not succeeded
+        self._window_bytes += transferred_bytes
+        if not self.adaptive or self._window_done < self.limit:
+            return
+        now = time.perf_counter()
+        throughput = self._window_bytes / max(now - self._window_started, 1e-9)
+        if self._window_errors / self._window_done > self.error_threshold:
+            new_limit = max(self.min_concurrency, self.limit // 2)
+        elif self._last_change > 0 and self._last_throughput and throughput < self._last_throughput * 0.95:
+            new_limit = max(self.min_concurrency, self.limit - 1)
+        else:
+            new_limit = min(self.max_concurrency, self.limit + 1)
+        if new_limit != self.limit:
+            print(f"Concurrency {self.limit} -> {new_limit}  (throughput {throughput / (1024 * 1024):.2f} MB/s, "
+                  f"{self._window_errors}/{self._window_done} failed)")
+        self._last_change = new_limit - self.limit
+        self._last_throughput = throughput
+        self.limit = new_limit
+        self._window_started = now
+        self._window_done = self._window_errors = self._window_bytes = 0
+
+    def retry_delay(self, failures):
+        """Return the backoff before retrying a job that failed `failures` times, or None to give up."""
+        if failures > self.max_retries or not self.retry_budget.take():
+            return None
+        self.retries += 1
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (failures - 1)))
+
+
+def controller_from_settings(settings, concurrency_key, retry_budget=None):
+    """Build a TransferController from settings.yaml, using `concurrency_key` for the starting concurrency.
+
+    `retry_budget` is a RetryBudget to share with other controllers; by default
+    the controller gets its own from the retry_budget setting.
+    """
+    return TransferController(
+        concurrency=max(1, int(settings.get(concurrency_key, 1))),
+        adaptive=settings.get('adaptive_concurrency', False),
+        min_concurrency=settings.get('min_concurrency', 1),
+        max_concurrency=settings.get('max_concurrency', 16),
+        max_retries=settings.get('retry_attempts', 0),
+        retry_budget=retry_budget or settings.get('retry_budget', 100),
+        backoff_base=settings.get('retry_backoff_base', 1.0),
+        backoff_max=settings.get('retry_backoff_max', 60.0),
+    )
+
+
+class BeeNode:
+    """One Bee node work can be sent to: its settings, its controller and the jobs it is running."""
+
+    def __init__(self, name, settings, controller):
+        self.name = name
+        self.settings = settings
+        self.controller = controller
+        self.in_flight = 0
+        self.outstanding_bytes = 0
+        # Set by upload_files/download_files from the node's own settings
+        self.upload_function = None
+        self.batch_function = None
+        self.download_function = None
+
+    def load(self):
+        """Bytes in flight per allowed transfer, a proxy for when the node will be free again."""
+        return self.outstanding_bytes / self.controller.limit
+
+
+def nodes_from_settings(settings, concurrency_key):
+    """Build the BeeNodes listed under bee_nodes, or a single node from the top-level settings.
+
+    Each bee_nodes entry may set name, bee_api_endpoint, stamp_id and its own
+    upload_concurrency/download_concurrency (or concurrency for both); anything
+    not set is taken from the top-level settings. The nodes share one
+    retry_budget for the whole run.
+    """
+    node_entries = settings.get('bee_nodes') or [{}]
+    retry_budget = RetryBudget(settings.get('retry_budget', 100))
+    nodes = []
+    for i, entry in enumerate(node_entries):
+        node_settings = dict(settings)
+        node_settings.update({key: value for key, value in entry.items() if key not in ('name', 'concurrency')})
+        if concurrency_key not in entry and 'concurrency' in entry:
+            node_settings[concurrency_key] = entry['concurrency']
+        name = entry.get('name') or node_settings.get('bee_api_endpoint') or f"node{i + 1}"
+        nodes.append(BeeNode(name, node_settings, controller_from_settings(node_settings, concurrency_key, retry_budget)))
+    return nodes
+
+
+class JobFeed:
+    """Takes jobs from an iterator that may block, such as a pipeline queue, on a daemon thread.
+
+    `request()` returns a Future that gets the next job, or None once the
+    iterator is exhausted, so the caller can wait for it together with the
+    running transfers.
+    """
+
+    def __init__(self, jobs):
+        self._requests = queue.Queue()
+        threading.Thread(target=self._run, args=(jobs,), name='job-feed', daemon=True).start()
+
+    def request(self):
+        future = Future()
+        self._requests.put(future)
+        return future
+
+    def _run(self, jobs):
+        while True:
+            future = self._requests.get()
+            if future is None:
+                return
+            try:
+                future.set_result(next(jobs, None))
+            except BaseException as e:
+                future.set_exception(e)
+                return
+
+    def close(self):
+        self._requests.put(None)
+
+
+def run_on_nodes(jobs, nodes, run_job, on_done, job_size=None, largest_first=False, streaming=False, stop=None):
+    """Run jobs on a thread pool, spread over Bee nodes.
+
+    Each node runs at most `node.controller.limit` jobs at once. A free slot
+    goes to the node with the least outstanding bytes per slot, as given by
+    `job_size`. With `largest_first` set, all jobs are read and dispatched
+    largest first (LPT bin packing); otherwise they are consumed lazily in
+    order. With `streaming` set, `jobs` may block waiting for the next job: it
+    is read on a JobFeed, one job whenever a slot is free, while finished jobs
+    and retries are handled. `run_job(node, job)` runs on a worker thread.
+    `on_done(node, job, result)` runs on the calling thread, records the result
+    and returns (succeeded, transferred_bytes). Failed jobs are retried after
+    the backoff of the node that failed them, on whichever node is free then.
+    On CTRL-C, or once the `stop` Event is set, no more jobs are started and the
+    running ones are waited for and passed to `on_done`, as they cannot be aborted.
+    Returns the jobs that still failed after their last attempt.
+    """
+    executor = ThreadPoolExecutor(max_workers=sum(node.controller.max_concurrency for node in nodes))
+    if largest_first and job_size is not None:
+        jobs = sorted(jobs, key=job_size, reverse=True)
+    jobs = iter(jobs)
+    feed = JobFeed(jobs) if streaming else None
+    fetch = None  # Future of the job being taken from the feed
+    size_of = job_size or (lambda job: 0)
+    in_flight = {}
+    retry_queue = []  # (ready at, sequence, job, failures so far)
+    sequence = itertools.count()
+    failed_jobs = []
+    exhausted = False
+
+    def next_job():
+        nonlocal exhausted, fetch
+        if retry_queue and retry_queue[0][0] <= time.monotonic():
+            _, _, job, failures = heapq.heappop(retry_queue)
+            return job, failures
+        if exhausted:
+            return None, 0
+        if feed is None:
+            job = next(jobs, None)
+        else:
+            if fetch is None:
+                fetch = feed.request()
+            if not fetch.done():
+                return None, 0
+            job, fetch = fetch.result(), None
+        if job is None:
+            exhausted = True
+            return None, 0
+        return job, 0
+
+    def finish_running():
+        running = [future for future in in_flight if not future.cancel()]
+        if running:
+            print(f"Stopping, waiting for {len(running)} running transfers to finish (CTRL-C again to abort)...")
+        for future in running:
+            node, job, _ = in_flight.pop(future)
+            on_done(node, job, future.result())
+
+    try:
+        while True:
+            if stop is not None and stop.is_set():
+                finish_running()
+                return failed_jobs
+            while True:
+                free_nodes = [node for node in nodes if node.in_flight < node.controller.limit]
+                if not free_nodes:
+                    break
+                job, failures = next_job()
+                if job is None:
+                    break
+                node = min(free_nodes, key=BeeNode.load)
+                node.in_flight += 1
+                node.outstanding_bytes += size_of(job)
+                in_flight[executor.submit(run_job, node, job)] = (node, job, failures)
+            if not in_flight and not retry_queue and exhausted:
+                return failed_jobs
+            timeout = max(0.0, retry_queue[0][0] - time.monotonic()) if retry_queue else None
+            if stop is not None:
+                timeout = STOP_POLL_INTERVAL if timeout is None else min(timeout, STOP_POLL_INTERVAL)
+            # A job already taken from the feed waits for a free slot, not the other way round
+            waiting_for = set(in_flight) | ({fetch} if fetch is not None and not fetch.done() else set())
+            if not waiting_for:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(waiting_for, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in in_flight:
+                    continue
+                node, job, failures = in_flight.pop(future)
+                node.in_flight -= 1
+                node.outstanding_bytes -= size_of(job)
+                succeeded, transferred_bytes = on_done(node, job, future.result())
+                node.controller.record(succeeded, transferred_bytes)
+                if succeeded:
+                    continue
+                delay = node.controller.retry_delay(failures + 1)
+                if delay is None:
+                    failed_jobs.append(job)
+                else:
+                    heapq.heappush(retry_queue, (time.monotonic() + delay, next(sequence), job, failures + 1))
+    except KeyboardInterrupt:
+        # Running transfers finish anyway, record them so they are not transferred again later
+        finish_running()
+        raise
+    finally:
+        if feed is not None:
+            feed.close()
+        executor.shutdown(wait=not in_flight, cancel_futures=True)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import re
+import time
+from datetime import datetime
+
+# Format passed to /usr/bin/time -f for swarm-cli transfers
+TIME_FORMAT = '"%e real,%U user,%S sys,%M KB max memory,%P CPU"'
+
+TIME_OUTPUT_PATTERN = re.compile(
+    r'([\d.]+) real,([\d.]+) user,([\d.]+) sys,(\d+) KB max memory,([\d.?]+)%? CPU')
+
+
+class TransferTimer:
+    """Times one transfer on the monotonic clock.
+
+    `mark_sent()` is called once the request body has been sent and
+    `mark_first_byte()` when the response starts to arrive. Either may be left out
+    when the backend cannot observe it (swarm-cli).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sent = None
+        self.first_byte = None
+
+    def mark_sent(self):
+        self.sent = time.perf_counter()
+
+    def mark_first_byte(self):
+        # Ranged downloads mark every part, the first one to arrive counts
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+
+    def metrics(self, transferred_bytes):
+        """Return the numeric metrics of the transfer, with all durations in seconds."""
+        ended = time.perf_counter()
+        duration = ended - self.started
+        if self.sent is not None:
+            # Upload: the body transfer ends when the request is sent, Bee then answers
+            transfer = self.sent - self.started
+        elif self.first_byte is not None:
+            # Download: the body transfer starts with the first byte of the response
+            transfer = ended - self.first_byte
+        else:
+            transfer = duration
+        return {
+            "duration_s": round(duration, 6),
+            "ttfb_s": round(self.first_byte - self.started, 6) if self.first_byte is not None else None,
+            "transfer_s": round(transfer, 6),
+            "bytes": transferred_bytes,
+            "bytes_per_s": round(transferred_bytes / duration, 1) if duration > 0 else None,
+        }
+
+
+def parse_time_output(time_output):
+    """Parse the /usr/bin/time line written for TIME_FORMAT into numbers, or return None."""
+    match = TIME_OUTPUT_PATTERN.search(time_output or '')
+    if not match:
+        return None
+    real, user, sys, max_memory, cpu = match.groups()
+    return {
+        "real_s": float(real),
+        "user_s": float(user),
+        "sys_s": float(sys),
+        "max_rss_kb": int(max_memory),
+        "cpu_percent": float(cpu) if cpu != '?' else None,
+    }
+
+
+def attempt_speed_MBps(attempt, file_size_bytes):
+    """Average speed of an attempt in MB/s, or None when it cannot be determined.
+
+    Uses the bytes and monotonic duration recorded in `metrics`, so a file
+    uploaded in a batch gets the throughput of its batch. Older attempts only
+    have second-resolution timestamps, which are used as a fallback.
+    """
+    metrics = attempt.get('metrics') or {}
+    if metrics.get('bytes') and metrics.get('bytes_per_s'):
+        return metrics['bytes_per_s'] / (1024 * 1024)
+    duration = metrics.get('duration_s')
+    if duration is None:
+        try:
+            FMT = '%Y-%m-%d %H:%M:%S'
+            tdelta = datetime.strptime(attempt['timestamp_end'], FMT) - datetime.strptime(attempt['timestamp_start'], FMT)
+            duration = tdelta.total_seconds()
+        except (KeyError, TypeError, ValueError):
+            return None
+    if duration <= 0:
+        return None
+    return file_size_bytes / (1024 * 1024) / duration
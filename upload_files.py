@@ -6,8 +6,16 @@ import argparse
 import subprocess
 from datetime import datetime
 import re
-import tempfile
-import shutil
+import functools
+import tarfile
+from urllib.parse import quote
+from bee_api import BeeClient, UPLOAD_BLOCK_SIZE
+from filelist_state import open_state
+from transfer_metrics import TransferTimer, TIME_FORMAT, parse_time_output
+from bee_monitor import start_sampler, with_bee_samples
+from transfer_controller import run_on_nodes, nodes_from_settings
+from dedup_index import open_dedup_index
+from live_metrics import start_live_metrics
 
 
 def load_settings(settings_path):
@@ -15,34 +23,18 @@ def load_settings(settings_path):
         return yaml.safe_load(f)
 
 
-def load_filelist(filelist_path):
-    with open(filelist_path, 'r') as f:
-        return json.load(f)
-
-
-def save_filelist(filelist, filelist_path):
-    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filelist_path), delete=False) as tempf:
-        json.dump(filelist, tempf, indent=4)
-    shutil.move(tempf.name, filelist_path)
-
-
-# Function to calculate duration and average speed
-def calculate_duration_and_speed(timestamp_start, timestamp_end, file_size_bytes):
-    try:
-        start_time = datetime.strptime(timestamp_start, "%Y-%m-%d %H:%M:%S")
-        end_time = datetime.strptime(timestamp_end, "%Y-%m-%d %H:%M:%S")
-        duration = (end_time - start_time).total_seconds()
-        file_size_MB = file_size_bytes / (1024 * 1024)
-        avg_speed = file_size_MB / duration if duration > 0 else 0
-        return round(file_size_MB, 2), round(avg_speed, 2)
-    except Exception as e:
-        return None, None
+# Function to calculate size in MB and average speed from the attempt metrics
+def calculate_size_and_speed(file_size_bytes, metrics):
+    file_size_MB = file_size_bytes / (1024 * 1024)
+    duration = metrics['duration_s']
+    avg_speed = file_size_MB / duration if duration > 0 else 0
+    return round(file_size_MB, 2), round(avg_speed, 2)
 
 
 def upload_file(file_info, settings):
     timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     cmd = [
-        '/usr/bin/time', '-f', '"%e real,%U user,%S sys,%M KB max memory,%P CPU"',  # Formatting for time output
+        '/usr/bin/time', '-f', TIME_FORMAT,  # Formatting for time output
         'swarm-cli', 'upload', file_info['full_path'],
         '--quiet',
         '--stamp', settings['stamp_id'],
@@ -56,16 +48,19 @@ def upload_file(file_info, settings):
 
     print(f"Working on file: {file_info['full_path']}  start: {timestamp_start}")
     swarm_output = None  # Define swarm_output here to have the correct scope
+    timer = TransferTimer()
 
     try:
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         output, errors = process.communicate()
 
         timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        file_size_MB, avg_speed = calculate_duration_and_speed(timestamp_start, timestamp_end, file_info['size'])
+        metrics = timer.metrics(file_info['size'] if process.returncode == 0 else 0)
+        file_size_MB, avg_speed = calculate_size_and_speed(file_info['size'], metrics)
 
         # Parse the time command output from errors (since it's redirected to stderr)
         time_output = errors.decode('utf-8').strip()
+        process_metrics = parse_time_output(time_output)
 
         if process.returncode == 0:
             swarm_output = output.decode('utf-8').strip()
@@ -74,70 +69,376 @@ def upload_file(file_info, settings):
                 file_info['swarmHash'] = swarm_hash.group(1)
             print(
                 f"Successfully uploaded: {file_info['full_path']}  end: {timestamp_end}  Size: {file_size_MB} MB  Average speed: {avg_speed} MB/s")
-            print(f"Time metrics: {time_output}")
-            return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "time_metrics": time_output,
-                    "response_body": swarm_output}
+            print(f"Time metrics: {metrics}  Process: {process_metrics}")
+            return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "metrics": metrics,
+                    "process_metrics": process_metrics, "response_body": swarm_output}
         else:
             print(f"Failed to upload: {file_info['full_path']}  end: {timestamp_end}  Size: {file_size_MB} MB")
-            print(f"Time metrics: {time_output}")
-            return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "time_metrics": time_output,
-                    "error": output.decode('utf-8').strip()}
+            print(f"Time metrics: {metrics}  Process: {process_metrics}")
+            return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "metrics": metrics,
+                    "process_metrics": process_metrics, "error": output.decode('utf-8').strip() or time_output}
 
     except Exception as e:
         timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(
-            f"An error occurred while uploading: {file_info['full_path']}  end: {timestamp_end}  Size: {file_size_MB if 'file_size_MB' in locals() else 'Unknown'} MB")
-        print(f"Time metrics: {time_output if 'time_output' in locals() else 'Unknown'}")
+        metrics = timer.metrics(0)
+        print(f"An error occurred while uploading: {file_info['full_path']}  end: {timestamp_end}  Error: {e}")
+        print(f"Time metrics: {metrics}")
         return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "error": str(e),
-                "time_metrics": time_output if 'time_output' in locals() else 'Unknown'}
+                "metrics": metrics}
+
+
+def upload_file_http(file_info, settings, bee_client):
+    """Upload a file by talking to the Bee /bzz API directly instead of spawning swarm-cli."""
+    timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"Working on file: {file_info['full_path']}  start: {timestamp_start}")
+    timer = TransferTimer()
+
+    try:
+        response = bee_client.upload_file(file_info['full_path'], settings['stamp_id'],
+                                          deferred=settings['deferred_upload'], name=file_info['filename'],
+                                          timer=timer)
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = timer.metrics(file_info['size'])
+        file_size_MB, avg_speed = calculate_size_and_speed(file_info['size'], metrics)
+
+        file_info['swarmHash'] = response['reference']
+        print(
+            f"Successfully uploaded: {file_info['full_path']}  end: {timestamp_end}  Size: {file_size_MB} MB  Average speed: {avg_speed} MB/s")
+        print(f"Time metrics: {metrics}")
+        return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "metrics": metrics,
+                "response_body": json.dumps(response)}
+
+    except Exception as e:
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = timer.metrics(0)
+        print(f"Failed to upload: {file_info['full_path']}  end: {timestamp_end}  Error: {e}")
+        print(f"Time metrics: {metrics}")
+        return {"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "metrics": metrics,
+                "error": str(e)}
+
+
+class TarStream:
+    """A tar archive of files generated while it is being sent, without staging it on disk.
+
+    The archive size is known up front so it can be sent with a Content-Length.
+    Iterating again regenerates the archive from the start, which lets the HTTP
+    client retry the request.
+    """
+
+    def __init__(self, members):
+        # members: list of (path inside the archive, path on disk, size)
+        self.headers = []
+        self.size = 0
+        for name, full_path, size in members:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = size
+            tarinfo.mode = 0o644
+            header = tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+            self.headers.append((header, full_path, size))
+            self.size += len(header) + size + self._padding(size)
+        self.size += 2 * tarfile.BLOCKSIZE  # End of archive marker
+
+    @staticmethod
+    def _padding(size):
+        return -size % tarfile.BLOCKSIZE
+
+    def __iter__(self):
+        for header, full_path, size in self.headers:
+            yield header
+            remaining = size
+            with open(full_path, 'rb') as f:
+                while remaining:
+                    block = f.read(min(remaining, UPLOAD_BLOCK_SIZE))
+                    if not block:
+                        raise IOError(f"{full_path} is shorter than the {size} bytes in the filelist")
+                    remaining -= len(block)
+                    yield block
+            yield b'\0' * self._padding(size)
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def upload_batch_http(file_infos, settings, bee_client):
+    """Upload several small files as one tar collection and return one attempt per file.
+
+    Each file's swarmHash becomes "<collection reference>/<path>", which Bee and
+    the gateways resolve to the file itself.
+    """
+    timestamp_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    batch_size = sum(file_info['size'] for file_info in file_infos)
+    print(f"Working on batch of {len(file_infos)} files ({batch_size} bytes)  start: {timestamp_start}")
+    timer = TransferTimer()
+
+    try:
+        tar_stream = TarStream([(file_info['filename'], file_info['full_path'], file_info['size'])
+                                for file_info in file_infos])
+        response = bee_client.upload_collection(tar_stream, settings['stamp_id'],
+                                                deferred=settings['deferred_upload'], timer=timer)
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = timer.metrics(batch_size)
+        file_size_MB, avg_speed = calculate_size_and_speed(batch_size, metrics)
+        print(f"Successfully uploaded batch of {len(file_infos)} files  end: {timestamp_end}  Size: {file_size_MB} MB  Average speed: {avg_speed} MB/s")
+        print(f"Time metrics: {metrics}")
+
+        attempts = []
+        for file_info in file_infos:
+            file_info['swarmHash'] = f"{response['reference']}/{quote(file_info['filename'])}"
+            attempts.append({"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "metrics": metrics,
+                             "collection": {"reference": response['reference'], "path": file_info['filename'],
+                                            "files": len(file_infos)},
+                             "response_body": json.dumps(response)})
+        return attempts
+
+    except Exception as e:
+        timestamp_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics = timer.metrics(0)
+        print(f"Failed to upload batch of {len(file_infos)} files  end: {timestamp_end}  Error: {e}")
+        return [{"timestamp_start": timestamp_start, "timestamp_end": timestamp_end, "metrics": metrics,
+                 "error": str(e)} for _ in file_infos]
+
+
+def get_batch_function(settings):
+    """Return the function uploading batches of small files, or None when batching is disabled."""
+    if not settings.get('batch_small_files_below'):
+        return None
+    bee_client = BeeClient(settings.get('bee_api_endpoint'))
+    return functools.partial(upload_batch_http, bee_client=bee_client)
+
+
+def get_upload_function(settings):
+    """Return the upload function for the configured upload_backend ("swarm-cli" or "http")."""
+    upload_backend = settings.get('upload_backend', 'swarm-cli')
+    if upload_backend == 'http':
+        bee_client = BeeClient(settings.get('bee_api_endpoint'))
+        return functools.partial(upload_file_http, bee_client=bee_client)
+    if upload_backend == 'swarm-cli':
+        return upload_file
+    raise ValueError(f"Unknown upload_backend: {upload_backend}")
+
+
+def select_files_to_upload(file_list, upload_filter, max_file_size):
+    """Yield the entries of the filelist that should be uploaded in this run."""
+    for file_info in file_list:
+        # Files marked as removed by an incremental re-scan are no longer on disk
+        if file_info.get('removed'):
+            continue
+        # Skip this file if we are uploading only 'pending' files and this file has a swarmHash
+        if upload_filter == 'pending' and 'swarmHash' in file_info:
+            continue
+        if file_info['size'] > max_file_size:
+            print(f"Skipping {file_info['filename']} due to size exceeding max_file_size.")
+            continue
+        yield file_info
+
+
+def size_matches(file_info):
+    """Whether the file is still on disk with the size recorded in the filelist."""
+    try:
+        return os.stat(file_info['full_path']).st_size == file_info['size']
+    except OSError:
+        return False
+
+
+def plan_upload_jobs(files_to_upload, settings, batching):
+    """Group files into upload jobs: lists of one file, or batches of small files.
+
+    Files below batch_small_files_below bytes are collected into batches of at
+    most batch_max_files files and batch_max_bytes bytes. A batch never holds two
+    files with the same name, as the name is their path inside the collection.
+    Files that are missing or no longer have the size in the filelist would break
+    the whole tar stream, so they are uploaded on their own and fail by themselves.
+    """
+    threshold = settings.get('batch_small_files_below', 0) if batching else 0
+    max_files = settings.get('batch_max_files', 1000)
+    max_bytes = settings.get('batch_max_bytes', 64 * 1024 * 1024)
+    batch, batch_bytes, batch_names = [], 0, set()
+    for file_info in files_to_upload:
+        if file_info['size'] >= threshold or not size_matches(file_info):
+            yield [file_info]
+            continue
+        if batch and (len(batch) >= max_files or batch_bytes + file_info['size'] > max_bytes
+                      or file_info['filename'] in batch_names):
+            yield batch
+            batch, batch_bytes, batch_names = [], 0, set()
+        batch.append(file_info)
+        batch_bytes += file_info['size']
+        batch_names.add(file_info['filename'])
+    if batch:
+        yield batch
+
+
+def get_upload_nodes(settings, bee_sampler=None):
+    """Return the Bee nodes to upload to, each with the upload functions for its endpoint and stamp."""
+    nodes = nodes_from_settings(settings, 'upload_concurrency')
+    for node in nodes:
+        node.upload_function = get_upload_function(node.settings)
+        node.batch_function = get_batch_function(node.settings)
+        if bee_sampler:
+            node.upload_function = with_bee_samples(node.upload_function, bee_sampler)
+            if node.batch_function:
+                node.batch_function = with_bee_samples(node.batch_function, bee_sampler)
+    return nodes
+
+
+def deduplicated_attempt(record):
+    """Upload attempt recorded for a file whose content the dedup index already knows."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {"timestamp_start": timestamp, "timestamp_end": timestamp,
+            "metrics": {"duration_s": 0.0, "ttfb_s": None, "transfer_s": 0.0, "bytes": 0, "bytes_per_s": None},
+            "deduplicated": record['reference'], "response_body": ""}
+
+
+def skip_uploaded(files_to_upload, dedup_index, on_attempt, held=None):
+    """Yield the files whose content is not in the dedup index yet; the others reuse its reference.
+
+    With `held` given, a file with the same content as one yielded earlier is
+    put there instead of being yielded, to be looked up again once that one is
+    uploaded.
+    """
+    in_flight = set()
+    for file_info in files_to_upload:
+        record = dedup_index.lookup(file_info)
+        if record:
+            on_attempt(file_info, deduplicated_attempt(record), record['reference'])
+            continue
+        key = (file_info['sha256'], file_info['size'])
+        if held is not None and key in in_flight:
+            held.append(file_info)
+            continue
+        in_flight.add(key)
+        yield file_info
+
+
+def run_uploads(files_to_upload, settings, nodes, on_attempt, dedup_index=None, streaming=False, stop=None):
+    """Upload files through a pool of worker threads spread over one or more Bee nodes.
+
+    Jobs are single files, or batches of small files when the nodes have a
+    `batch_function`. With several nodes, jobs are dispatched largest first to
+    the least loaded node. Workers get a copy of the file entries; each attempt,
+    including retries, gets the "bee_node" that handled it and is handed to
+    `on_attempt(file_info, upload_attempt, swarm_hash)` on the calling thread, so
+    the filelist is only ever modified and saved from one thread. With a
+    `dedup_index`, content uploaded before is not uploaded again and every new
+    upload is added to the index. With `streaming` set, `files_to_upload` may
+    block waiting for files (see run_on_nodes), they are uploaded in the order
+    they arrive, and deduplicated files are handed to `on_attempt` on the thread
+    that reads them. Setting the `stop` Event ends the run once the running
+    uploads are recorded. Returns the entries whose upload still failed after
+    all retries.
+    """
+    if dedup_index is None:
+        return _run_upload_jobs(files_to_upload, settings, nodes, on_attempt, None, streaming, stop)
+    held = []
+    failed = _run_upload_jobs(skip_uploaded(files_to_upload, dedup_index, on_attempt, held),
+                              settings, nodes, on_attempt, dedup_index, streaming, stop)
+    # Duplicates of files uploaded in this run, only uploaded when the first copy failed
+    failed += _run_upload_jobs(skip_uploaded(held, dedup_index, on_attempt), settings, nodes, on_attempt, dedup_index,
+                               stop=stop)
+    return failed
+
+
+def _run_upload_jobs(files_to_upload, settings, nodes, on_attempt, dedup_index, streaming=False, stop=None):
+    def run_job(node, job):
+        _, worker_file_infos = job
+        if len(worker_file_infos) == 1:
+            return [node.upload_function(worker_file_infos[0], node.settings)]
+        return node.batch_function(worker_file_infos, node.settings)
+
+    def on_done(node, job, upload_attempts):
+        file_infos, worker_file_infos = job
+        for file_info, worker_file_info, upload_attempt in zip(file_infos, worker_file_infos, upload_attempts):
+            upload_attempt['bee_node'] = node.name
+            swarm_hash = worker_file_info.get('swarmHash')
+            if dedup_index is not None and swarm_hash and "error" not in upload_attempt:
+                dedup_index.add(file_info, swarm_hash, node.settings.get('stamp_id'))
+            on_attempt(file_info, upload_attempt, swarm_hash)
+        succeeded = all("error" not in upload_attempt for upload_attempt in upload_attempts)
+        return succeeded, sum(file_info['size'] for file_info in file_infos) if succeeded else 0
+
+    def job_size(job):
+        return sum(file_info['size'] for file_info in job[0])
+
+    batching = all(node.batch_function is not None for node in nodes)
+    jobs = ((file_infos, [dict(file_info) for file_info in file_infos])
+            for file_infos in plan_upload_jobs(files_to_upload, settings, batching))
+    failed_jobs = run_on_nodes(jobs, nodes, run_job, on_done, job_size,
+                               largest_first=len(nodes) > 1 and not streaming, streaming=streaming, stop=stop)
+    return [file_info for file_infos, _ in failed_jobs for file_info in file_infos]
 
 
 if __name__ == '__main__':
     try:
         successful_count = 0
         unsuccessful_count = 0
+        deduplicated_count = 0
         total_data_uploaded = 0  # In bytes
+        live_metrics = None
+        bee_sampler = None
 
         parser = argparse.ArgumentParser(description='Upload files.')
         parser.add_argument('-S', '--settings', help='Path to settings YAML file', default='settings.yaml')
         args = parser.parse_args()
 
         settings = load_settings(args.settings)
-        file_list = load_filelist(settings['file_info_path'])
+        state = open_state(settings)
+        file_list = state.file_list
 
         upload_filter = settings.get('upload_filter', 'all')  # Default to 'all' if not specified
 
         # This would get the max_file_size setting from the YAML file
         max_file_size = settings.get('max_file_size', float('inf'))  # Use a large number as the default
 
-        for file_info in file_list:
-            # Skip this file if we are uploading only 'pending' files and this file has a swarmHash
-            if upload_filter == 'pending' and 'swarmHash' in file_info:
-                continue
-            if file_info['size'] > max_file_size:
-                print(f"Skipping {file_info['filename']} due to size exceeding max_file_size.")
-                continue
+        # Bee nodes to upload to, each with its own stamp, parallel uploads and retries
+        bee_sampler = start_sampler(settings)
+        nodes = get_upload_nodes(settings, bee_sampler)
+
+        # Content uploaded before, under any path or in any filelist, is not uploaded again
+        dedup_index = open_dedup_index(settings)
 
-            upload_attempt = upload_file(file_info, settings)
+        files_to_upload = list(select_files_to_upload(file_list, upload_filter, max_file_size))
 
-            if "error" not in upload_attempt:
+        # Progress published while the upload runs (metrics_port / metrics_file)
+        live_metrics = start_live_metrics(settings)
+        upload_metrics = None
+        if live_metrics:
+            upload_metrics = live_metrics.add_stage('upload', nodes, len(files_to_upload),
+                                                    sum(file_info['size'] for file_info in files_to_upload))
+
+        def record_upload_attempt(file_info, upload_attempt, swarm_hash):
+            global successful_count, total_data_uploaded, deduplicated_count
+            if upload_attempt.get('deduplicated'):
+                deduplicated_count += 1
+            elif "error" not in upload_attempt:
                 successful_count += 1
                 total_data_uploaded += file_info['size']
-                file_info.setdefault('upload_attempts', []).append(
-                    upload_attempt)  # Set default for 'upload_attempts' if not exists
-            else:
-                unsuccessful_count += 1
-                file_info.setdefault('upload_attempts', []).append(
-                    upload_attempt)  # Set default for 'upload_attempts' if not exists
+            state.update(file_info,
+                         set_fields={'swarmHash': swarm_hash} if swarm_hash else None,
+                         append_fields={'upload_attempts': upload_attempt})
+            if upload_metrics and upload_attempt.get('deduplicated'):
+                upload_metrics.skip(file_info['size'])
+            elif upload_metrics:
+                upload_metrics.record("error" not in upload_attempt, file_info['size'])
 
-            save_filelist(file_list, settings['file_info_path'])
+        failed_uploads = run_uploads(files_to_upload, settings, nodes, record_upload_attempt, dedup_index)
+        unsuccessful_count = len(failed_uploads)
+        state.close()
+        if dedup_index:
+            dedup_index.close()
+        if live_metrics:
+            live_metrics.stop()
+        if bee_sampler:
+            bee_sampler.stop()
 
         total_data_uploaded_MB = total_data_uploaded / (1024 * 1024)
         print(f"\nSuccessfully uploaded {successful_count} files.")
         print(f"Failed to upload {unsuccessful_count} files.")
+        print(f"Reused the Swarm reference of identical content for {deduplicated_count} files.")
+        print(f"Retried uploads: {sum(node.controller.retries for node in nodes)}")
         print(f"Total data uploaded: {total_data_uploaded_MB:.2f} MBytes")
     except KeyboardInterrupt:
         print("CTRL-C detected. Attempting to save JSON file before exiting.")
-        save_filelist(file_list, settings['file_info_path'])
+        state.close()
+        if live_metrics:
+            live_metrics.stop()
+        if bee_sampler:
+            bee_sampler.stop()
         print("JSON file saved. Exiting now.")
-